@@ -0,0 +1,101 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A bounded cache that evicts the least recently used entry when it is full, and optionally
+    expires entries a fixed time after they were added.
+
+    Hits, misses, evictions and expiries are counted so the cache can be monitored.
+    """
+
+    def __init__(self, max_size=128, ttl=None, clock=time.monotonic):
+        """
+        Create the cache.
+
+        Parameters:
+        - max_size: The most entries the cache holds before evicting the least recently used one.
+        - ttl: Optional number of seconds an entry stays valid for after it was added.
+        - clock: Function returning the current time in seconds, used to expire entries.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expiries = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl is not None and self.clock() - entry[1] > self.ttl:
+            del self.entries[key]
+            self.expiries += 1
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        """
+        Get an entry from the cache, marking it as recently used.
+
+        Parameters:
+        - key: The key of the entry.
+        - default: Value returned if the entry is not in the cache, or has expired.
+
+        Returns:
+        - value: The cached value, or the default.
+        """
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, value):
+        """
+        Add an entry to the cache, evicting the least recently used entries if it is full.
+
+        Parameters:
+        - key: The key of the entry.
+        - value: The value to cache.
+        """
+        self.entries[key] = (value, self.clock())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        """
+        Get the counters of the cache.
+
+        Returns:
+        - stats: A dictionary of the size, hits, misses, evictions and expiries of the cache.
+        """
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expiries": self.expiries,
+        }
@@ -1,4 +1,8 @@
-import math
+from app.geodesy import (
+  are_points_on_lines,
+  calculate_next_coordinates,
+  haversine_distances,
+)
 
 def calculate_next_coordinate(start_coordinate, gradient, distance_meters):
     """
@@ -12,26 +16,8 @@ def calculate_next_coordinate(start_coordinate, gradient, distance_meters):
     Returns:
     - Tuple representing the next GPS coordinate (latitude, longitude).
     """
-    # Earth radius in meters
-    earth_radius = 6371000.0
-
-    # Convert latitude and longitude to radians
-    lat1, lon1 = math.radians(start_coordinate[0]), math.radians(start_coordinate[1])
-
-    # Calculate change in latitude and longitude
-    delta_lat = (distance_meters / earth_radius) * math.cos(gradient)
-    delta_lon = (distance_meters / earth_radius) * math.sin(gradient)
-
-    # Calculate new latitude
-    lat2 = lat1 + delta_lat
-
-    # Calculate new longitude
-    lon2 = lon1 + delta_lon
-
-    # Convert latitude and longitude back to degrees
-    lat2, lon2 = math.degrees(lat2), math.degrees(lon2)
-
-    return lat2, lon2
+    lat2, lon2 = calculate_next_coordinates(start_coordinate, gradient, distance_meters)[0]
+    return float(lat2), float(lon2)
 
 def is_point_on_line(A, B, X, precision=1e-10):
   """
@@ -47,19 +33,9 @@ def is_point_on_line(A, B, X, precision=1e-10):
      - If X lies on the line segment, the slope of the line.
      - If X lies on the line segment, the average distance between the trees on that line segment.
   """
-  # Calculate slopes
-  slope_AB = (B[1] - A[1]) / (B[0] - A[0]) if (B[0] - A[0]) != 0 else float('inf')
-  slope_AX = (X[1] - A[1]) / (X[0] - A[0]) if (X[0] - A[0]) != 0 else float('inf')
-
-  # Check if slopes are equal within the specified precision
-  if abs(slope_AB - slope_AX) < precision:
-      # Check if X lies within the bounding box of AB
-      if (
-          min(A[0], B[0]) <= X[0] <= max(A[0], B[0]) and
-          min(A[1], B[1]) <= X[1] <= max(A[1], B[1])
-        ):
-          avg_dist = ((haversine_distance(A,X)) + haversine_distance(B, X) ) / 2
-          return (True, slope_AB, avg_dist)
+  on_line, slope, avg_dist = are_points_on_lines(A, B, X, precision)
+  if on_line[0]:
+    return (True, float(slope[0]), float(avg_dist[0]))
 
   return (False, 0, 0)
 
@@ -90,19 +66,7 @@ def haversine_distance(coord1, coord2):
   Returns:
   - distance: Distance between the two coordinates in meters.
   """
-  R = 6371000  # Radius of the Earth in meters
-
-  lat1, lon1 = math.radians(coord1[0]), math.radians(coord1[1])
-  lat2, lon2 = math.radians(coord2[0]), math.radians(coord2[1])
-
-  dlat = lat2 - lat1
-  dlon = lon2 - lon1
-
-  a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
-  c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-  distance = R * c
-  return distance
+  return float(haversine_distances(coord1, coord2))
 
 
 def find_center_coord(coords):
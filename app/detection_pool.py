@@ -0,0 +1,209 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+import numpy as np
+from starlette.concurrency import run_in_threadpool
+from app.incremental import OrchardState
+from app.metrics import measured, merge, stage
+from app.lattice import detect_missing_trees_lattice, detect_missing_trees_lattice_converged
+from app.orchard_utils import detect_missing_trees, detect_missing_trees_converged
+from app.tiling import detect_tile, merge_tiled_detection, plan_tiled_detection
+
+# The missing tree detectors that can be chosen for each orchard
+ENGINES = {
+    "neighbours": detect_missing_trees,
+    "lattice": detect_missing_trees_lattice,
+}
+
+# The same detectors, run until no new missing trees are found. These also return the number of passes.
+CONVERGED_ENGINES = {
+    "neighbours": detect_missing_trees_converged,
+    "lattice": detect_missing_trees_lattice_converged,
+}
+
+
+class DetectionPoolBusy(Exception):
+    """
+    Raised when the detection pool already has as many orchards queued as it allows.
+    """
+
+
+class DetectionPool:
+    """
+    Runs the missing tree detection pipeline for large orchards in a pool of worker processes, so
+    that they do not hold the GIL of the server process and stall every other request.
+
+    Small orchards are cheap to process, so they are run in the server's threadpool instead, and
+    never wait behind large orchards in the pool's queue. The pool only accepts a limited number of
+    orchards at once, and rejects any more with DetectionPoolBusy until some have finished.
+
+    Very large orchards are split into tiles instead (see run_tiled), and the tiles are spread over
+    the workers, so that a single orchard can use every worker. This is
+    only done for the neighbours engine, as the lattice engine is a single linear pass.
+
+    Only the coordinates of the trees are sent to the workers, and missing trees are sent back, as
+    (N, 2) float64 arrays, so the other attributes of the trees never need to be pickled. The stage
+    timings of each run are sent back with them, and merged into the recorder of the request.
+    """
+
+    def __init__(self, workers=None, max_pending=None, inline_max_trees=2000, tile_min_trees=50000,
+                 tile_size=250.0):
+        """
+        Create the pool.
+
+        Parameters:
+        - workers: The number of worker processes. Defaults to the number of CPUs. If 0, every
+                   orchard is run in the threadpool.
+        - max_pending: The most orchards that can be running or queued in the pool at once.
+                       Defaults to twice the number of workers.
+        - inline_max_trees: Orchards with at most this many trees are run in the threadpool.
+        - tile_min_trees: Orchards with at least this many trees are split into tiles.
+        - tile_size: The width of a tile in meters.
+        """
+        self.executor = None
+        if workers != 0:
+            workers = workers or os.cpu_count() or 1
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+        self.workers = workers
+        self.max_pending = max_pending if max_pending is not None else 2 * (workers or 1)
+        self.inline_max_trees = inline_max_trees
+        self.tile_min_trees = tile_min_trees
+        self.tile_size = tile_size
+        self.pending = 0
+        self.slots = asyncio.Condition()
+        self.pooled = 0
+        self.inline = 0
+        self.tiled = 0
+        self.rejected = 0
+
+    async def run(self, coords, *args, engine="neighbours", converge=False, wait=False, inline=True):
+        """
+        Run a missing tree detector on an orchard.
+
+        Parameters:
+        - coords: TreeSet (or an (N, 2) array) of the GPS coordinates (latitude, longitude) of all trees.
+        - args: Other arguments passed on to the detector (min_group_size, precision, feature_tolerance).
+        - engine: The name of the detector in ENGINES.
+        - converge: If True, run the detector from CONVERGED_ENGINES instead.
+        - wait: If True, wait for space in the pool instead of raising DetectionPoolBusy when it is full.
+        - inline: If False, small orchards are run in the pool too. Batches of orchards use this, so
+                  that they are spread over every core rather than sharing the server's GIL.
+
+        Returns:
+        - missing_tree_coords: (M, 2) array of the GPS coordinates of the missing trees. If converging,
+                               this is returned along with the number of passes.
+
+        Raises:
+        - DetectionPoolBusy: If the orchard needs the pool, and the pool is full.
+        """
+        detector = CONVERGED_ENGINES[engine] if converge else ENGINES[engine]
+        coords = np.ascontiguousarray(coords, dtype=np.float64)
+        if self.executor is None or (inline and len(coords) <= self.inline_max_trees):
+            self.inline += 1
+            return merge(await run_in_threadpool(measured, detector, coords, *args))
+
+        async with self.slot(wait):
+            if detector is detect_missing_trees and len(coords) >= self.tile_min_trees:
+                self.tiled += 1
+                return await self.run_tiled(coords, *args)
+
+            loop = asyncio.get_running_loop()
+            return merge(await loop.run_in_executor(self.executor, measured, detector, coords, *args))
+
+    @asynccontextmanager
+    async def slot(self, wait=False):
+        """
+        Hold one of the pool's places for an orchard while the block runs.
+
+        Raises:
+        - DetectionPoolBusy: If the pool is full, and `wait` is False.
+        """
+        with stage("queue"):
+            async with self.slots:
+                if self.pending >= self.max_pending and not wait:
+                    self.rejected += 1
+                    raise DetectionPoolBusy(f"{self.pending} orchards are already being processed")
+                await self.slots.wait_for(lambda: self.pending < self.max_pending)
+                self.pending += 1
+
+        self.pooled += 1
+        try:
+            yield
+        finally:
+            async with self.slots:
+                self.pending -= 1
+                self.slots.notify()
+
+    async def build_state(self, trees, *args, wait=False):
+        """
+        Build the OrchardState of the first survey of an orchard, for incremental detection.
+
+        This runs the full pipeline, so large orchards are built in a worker process, under the same
+        limits as run, and the state is sent back. Small orchards are built in the threadpool.
+
+        Parameters:
+        - trees: TreeSet of the GPS coordinates of all trees, with an `id` attribute if the survey has them.
+        - args: Other arguments passed on to OrchardState (min_group_size, precision, feature_tolerance,
+                survey_id).
+        - wait: If True, wait for space in the pool instead of raising DetectionPoolBusy when it is full.
+
+        Returns:
+        - state: The OrchardState.
+
+        Raises:
+        - DetectionPoolBusy: If the orchard needs the pool, and the pool is full.
+        """
+        if self.executor is None or len(trees) <= self.inline_max_trees:
+            self.inline += 1
+            return merge(await run_in_threadpool(measured, OrchardState, trees, *args))
+
+        async with self.slot(wait):
+            loop = asyncio.get_running_loop()
+            return merge(await loop.run_in_executor(self.executor, measured, OrchardState, trees, *args))
+
+    async def run_tiled(self, coords, min_group_size=3, precision=2.5, feature_tolerance=None):
+        """
+        Run the neighbours detector on an orchard split into tiles (see tiling.detect_missing_trees_tiled).
+
+        The orchard is planned into tiles in one worker, the tiles are spread over every worker, and
+        they are merged in one worker, so none of the pipeline runs in the server process.
+
+        Returns:
+        - missing_tree_coords: (M, 2) array of the GPS coordinates of the missing trees.
+        """
+        loop = asyncio.get_running_loop()
+        projection, jobs = merge(await loop.run_in_executor(
+            self.executor, measured, plan_tiled_detection, coords, precision, feature_tolerance, self.tile_size))
+        with stage("tiles"):
+            results = await asyncio.gather(*(loop.run_in_executor(self.executor, detect_tile, job) for job in jobs))
+        return merge(await loop.run_in_executor(
+            self.executor, measured, merge_tiled_detection, projection, results, min_group_size))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        """
+        Get the counters of the pool.
+
+        Returns:
+        - stats: A dictionary of the pool size and limits, the orchards currently in the pool, and
+                 the total number of orchards run in the pool, run in tiles, run inline, and rejected.
+        """
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "inline_max_trees": self.inline_max_trees,
+            "tile_min_trees": self.tile_min_trees,
+            "tile_size": self.tile_size,
+            "pending": self.pending,
+            "pooled": self.pooled,
+            "inline": self.inline,
+            "tiled": self.tiled,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,137 @@
+import numpy as np
+
+# Radius of the Earth in meters
+EARTH_RADIUS = 6371000.0
+
+
+def as_coords(coords):
+  """
+  Convert GPS coordinates into an (N, 2) float64 array of (latitude, longitude) rows.
+
+  Parameters:
+  - coords: A single (latitude, longitude) tuple, a list of them, or an array.
+
+  Returns:
+  - coords: An (N, 2) float64 array.
+  """
+  return np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+
+
+def haversine_distances(coords1, coords2):
+  """
+  Calculate the distance on a sphere between GPS coordinates using the Haversine formula.
+  https://en.wikipedia.org/wiki/Haversine_formula
+
+  The inputs are broadcast against each other, so (N, 2) and (N, 2) arrays give the N
+  element-wise distances, and a (2,) coordinate against an (N, 2) array gives the distances
+  from that coordinate to every row.
+
+  Parameters:
+  - coords1: Array of (latitude, longitude) coordinates.
+  - coords2: Array of (latitude, longitude) coordinates.
+
+  Returns:
+  - distances: Array of distances between the coordinates in meters.
+  """
+  coords1 = np.asarray(coords1, dtype=np.float64)
+  coords2 = np.asarray(coords2, dtype=np.float64)
+
+  lat1, lon1 = np.radians(coords1[..., 0]), np.radians(coords1[..., 1])
+  lat2, lon2 = np.radians(coords2[..., 0]), np.radians(coords2[..., 1])
+
+  dlat = lat2 - lat1
+  dlon = lon2 - lon1
+
+  a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+  c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+  return EARTH_RADIUS * c
+
+
+def haversine_one_to_many(coord, coords):
+  """
+  Calculate the distance from one GPS coordinate to each of a set of coordinates.
+
+  Parameters:
+  - coord: Tuple (latitude, longitude) of the source coordinate.
+  - coords: (N, 2) array of (latitude, longitude) coordinates.
+
+  Returns:
+  - distances: (N,) array of distances in meters.
+  """
+  return haversine_distances(np.asarray(coord, dtype=np.float64)[None, :], as_coords(coords))
+
+
+def haversine_pairwise(coords1, coords2):
+  """
+  Calculate the distance between every pair of coordinates from two sets.
+
+  Parameters:
+  - coords1: (N, 2) array of (latitude, longitude) coordinates.
+  - coords2: (M, 2) array of (latitude, longitude) coordinates.
+
+  Returns:
+  - distances: (N, M) array of distances in meters.
+  """
+  return haversine_distances(as_coords(coords1)[:, None, :], as_coords(coords2)[None, :, :])
+
+
+def calculate_next_coordinates(start_coordinates, gradient, distance_meters):
+  """
+  Calculate the next GPS coordinates based on starting coordinates, gradients, and distances.
+
+  Parameters:
+  - start_coordinates: (N, 2) array of starting (latitude, longitude) coordinates.
+  - gradient: Gradient (slope) of the line, either a single value or one per coordinate.
+  - distance_meters: Distance to move in meters, either a single value or one per coordinate.
+
+  Returns:
+  - coords: (N, 2) array of the next (latitude, longitude) coordinates.
+  """
+  start_coordinates = as_coords(start_coordinates)
+  gradient = np.asarray(gradient, dtype=np.float64)
+  distance_meters = np.asarray(distance_meters, dtype=np.float64)
+
+  lat1, lon1 = np.radians(start_coordinates[:, 0]), np.radians(start_coordinates[:, 1])
+
+  delta_lat = (distance_meters / EARTH_RADIUS) * np.cos(gradient)
+  delta_lon = (distance_meters / EARTH_RADIUS) * np.sin(gradient)
+
+  return np.stack([np.degrees(lat1 + delta_lat), np.degrees(lon1 + delta_lon)], axis=-1)
+
+
+def are_points_on_lines(A, B, X, precision=1e-10, distance=haversine_distances):
+  """
+  Check if each point X lies on the line segment defined by the matching points A and B.
+
+  Parameters:
+  - A, B, X: (N, 2) arrays of (x, y) coordinates of points A, B, and X. A single point is
+             broadcast against the others.
+  - precision: Optional parameter to specify the precision for the check.
+  - distance: The function used to measure the distance between points. Defaults to the haversine
+              distance between GPS coordinates.
+
+  Returns:
+  - Tuple of the following (N,) arrays:
+     - True where X lies on the line segment AB within the specified precision, False otherwise.
+     - Where X lies on the line segment, the slope of the line, 0 otherwise.
+     - Where X lies on the line segment, the average distance between the trees on that line
+       segment, 0 otherwise.
+  """
+  A, B, X = np.broadcast_arrays(as_coords(A), as_coords(B), as_coords(X))
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    dx_AB = B[:, 0] - A[:, 0]
+    dx_AX = X[:, 0] - A[:, 0]
+    slope_AB = np.where(dx_AB != 0, (B[:, 1] - A[:, 1]) / dx_AB, np.inf)
+    slope_AX = np.where(dx_AX != 0, (X[:, 1] - A[:, 1]) / dx_AX, np.inf)
+
+    # Slopes must be equal within the specified precision, and X must lie within the bounding box of AB
+    on_line = (
+      (np.abs(slope_AB - slope_AX) < precision) &
+      (np.minimum(A[:, 0], B[:, 0]) <= X[:, 0]) & (X[:, 0] <= np.maximum(A[:, 0], B[:, 0])) &
+      (np.minimum(A[:, 1], B[:, 1]) <= X[:, 1]) & (X[:, 1] <= np.maximum(A[:, 1], B[:, 1]))
+    )
+
+  avg_dist = (distance(A, X) + distance(B, X)) / 2
+  return (on_line, np.where(on_line, slope_AB, 0.0), np.where(on_line, avg_dist, 0.0))
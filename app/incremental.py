@@ -0,0 +1,270 @@
+import numpy as np
+from app.geodesy import as_coords
+from app.metrics import record_count, stage
+from app.orchard_utils import expected_tree_locations, find_linked, find_tree_clusters, get_orchard_features
+from app.projection import LocalProjection
+from app.spatial_index import SpatialIndex
+from app.tree_set import TreeSet
+
+
+class OrchardState:
+  """
+  The state of the missing tree detection of an orchard, kept between surveys so that a new survey
+  only needs the parts of the orchard that changed to be checked again.
+
+  The first survey is run through the full pipeline, and its projection, orchard features, trees,
+  expected locations and clusters are kept. Each later survey is compared with the trees kept, by
+  tree id when both surveys have them, or by position otherwise. The expected locations of the
+  trees within one tree spacing (plus the precision) of a tree that was added, removed or moved are
+  found again, and only the clusters that those locations belong to are grouped again. Everything
+  else is reused, so an update costs about the same however big the orchard is.
+
+  Trees and expected locations are kept in slots that are never reused. A removed tree keeps its
+  slot but is marked as gone, and new trees are given new slots at the end. Expected locations are
+  keyed by 4 * the slot of their tree plus their direction, and the results come out in the same
+  order as the full pipeline would give for the trees in slot order.
+  """
+
+  def __init__(self, trees, min_group_size=3, precision=2.5, feature_tolerance=None, survey_id=None,
+               match_distance=0.5):
+    """
+    Run the full pipeline on the first survey of an orchard.
+
+    Parameters:
+    - trees: TreeSet (or an (N, 2) array) of the GPS coordinates (latitude, longitude) of all trees,
+             with an `id` attribute if the survey has tree ids.
+    - min_group_size: How many expected locations should agree for a tree to count as missing.
+    - precision: How close trees should be to a location, or to each other, in meters.
+    - feature_tolerance: Optional distance in meters to sample the orchard features to.
+    - survey_id: Optional id of the survey.
+    - match_distance: How far in meters a tree can move between surveys and still be the same tree.
+    """
+    trees = trees if isinstance(trees, TreeSet) else TreeSet(trees)
+    self.min_group_size = min_group_size
+    self.precision = precision
+    self.match_distance = match_distance
+    self.survey_id = survey_id
+
+    # Later surveys are projected about the centre of the first one, so every point stays comparable
+    with stage("index"):
+      self.projection = LocalProjection(trees)
+      points = self.projection.to_local(trees)
+      self.index = SpatialIndex(points, cell_size=precision)
+    with stage("features"):
+      self.features = get_orchard_features(points, self.index, feature_tolerance)
+    self.reach = max(abs(feature["dist"]) for feature in self.features) + precision
+
+    self.alive = np.ones(len(points), dtype=bool)
+    self.ids = self._tree_ids(trees)
+
+    # Expected locations that have no tree, by slot, and the slot of the location of each key
+    self.candidate_index = SpatialIndex(np.empty((0, 2)), cell_size=precision)
+    self.candidate_alive = np.zeros(0, dtype=bool)
+    self.candidate_keys = np.zeros(0, dtype=np.int64)
+    self.candidate_of_key = np.full(4 * len(points), -1, dtype=np.int64)
+
+    # The cluster of each expected location, and the members and centre of every cluster
+    self.labels = np.zeros(0, dtype=np.int64)
+    self.clusters = {}
+    self.centres = {}
+    self.next_label = 0
+
+    with stage("candidates"):
+      added = self._find_candidates(np.arange(len(points)))
+    with stage("groups"):
+      self._group(added)
+    record_count("trees", len(points))
+    record_count("candidates", len(added))
+
+  @staticmethod
+  def _tree_ids(trees):
+    ids = trees.attributes.get("id")
+    if ids is None:
+      return None
+    return np.asarray(ids, dtype=np.float64)
+
+  @property
+  def points(self):
+    return self.index.coords
+
+  def _any_tree_within(self, points, radius):
+    query_indices, tree_indices, _ = self.index.within_many(points, radius)
+    found = np.zeros(len(points), dtype=bool)
+    found[query_indices[self.alive[tree_indices]]] = True
+    return found
+
+  def _find_candidates(self, trees):
+    """
+    Find the expected locations of some trees that have no tree, and add them.
+
+    Returns:
+    - added: Array of the slots of the expected locations added.
+    """
+    trees = trees[self.alive[trees]]
+    expected = expected_tree_locations(self.points[trees], self.features)
+    keys = (4 * trees[:, None] + np.arange(4)).ravel()
+
+    # The index still holds the trees that were removed, so they are left out of the check
+    missing = ~self._any_tree_within(expected, self.precision)
+    added = self.candidate_index.insert(expected[missing])
+    self.candidate_alive = np.concatenate([self.candidate_alive, np.ones(len(added), dtype=bool)])
+    self.candidate_keys = np.concatenate([self.candidate_keys, keys[missing]])
+    self.labels = np.concatenate([self.labels, np.full(len(added), -1, dtype=np.int64)])
+    self.candidate_of_key[keys[missing]] = added
+    return added
+
+  def _remove_candidates(self, trees):
+    """
+    Remove every expected location of some trees.
+
+    Returns:
+    - removed: Array of the slots of the expected locations removed.
+    """
+    keys = (4 * trees[:, None] + np.arange(4)).ravel()
+    removed = self.candidate_of_key[keys]
+    removed = removed[removed >= 0]
+    self.candidate_of_key[keys] = -1
+    self.candidate_alive[removed] = False
+    return removed
+
+  def _group(self, added, removed=()):
+    """
+    Group the clusters of expected locations that changed again.
+
+    A cluster can only have changed if it lost a location, or if an added location is close
+    enough to join it. Every location linked to those is found again, and clustered in key order.
+    """
+    removed = np.asarray(removed, dtype=np.int64)
+    _, touched, _ = self.candidate_index.within_many(self.candidate_index.coords[added], self.precision)
+    touched = touched[self.candidate_alive[touched]]
+    stale = set(self.labels[removed].tolist()) | set(self.labels[touched].tolist())
+    stale.discard(-1)
+    self.labels[removed] = -1
+
+    seeds = [added] + [self.clusters.pop(label) for label in stale]
+    for label in stale:
+      self.centres.pop(label, None)
+    changed = find_linked(self.candidate_index, np.concatenate(seeds), self.precision, self.candidate_alive)
+    changed = changed[np.argsort(self.candidate_keys[changed], kind='stable')]
+    clusters = find_tree_clusters(TreeSet(self.candidate_index.coords[changed], {"slot": changed}), self.precision)
+    for cluster in clusters:
+      members = cluster["trees"].attributes["slot"]
+      label = self.next_label
+      self.next_label += 1
+      self.labels[members] = label
+      self.clusters[label] = members
+      if cluster["size"] >= self.min_group_size:
+        self.centres[label] = (self.candidate_keys[members[0]], cluster["trees"].center())
+
+    return len(stale), len(clusters)
+
+  def _match(self, trees, points):
+    """
+    Match the trees of a new survey with the trees kept.
+
+    Returns:
+    - kept: Slots of the trees that are in both surveys.
+    - removed: Slots of the trees that are not in the new survey.
+    - added: Indices in the new survey of the trees that are not kept.
+    - moved: How many of the removed and added trees are the same tree that moved.
+    - matched_by: 'id' or 'position'.
+    """
+    slots = np.flatnonzero(self.alive)
+    new_ids = self._tree_ids(trees)
+    if self.ids is not None and new_ids is not None and not np.isnan(new_ids).any():
+      old_ids = self.ids[slots]
+      order = np.argsort(old_ids, kind='stable')
+      at = np.minimum(np.searchsorted(old_ids[order], new_ids), max(len(slots) - 1, 0))
+      same_id = (old_ids[order][at] == new_ids) if len(slots) else np.zeros(len(new_ids), dtype=bool)
+      matched = slots[order[at[same_id]]]
+      moved = np.hypot(*(self.points[matched] - points[same_id]).T) > self.match_distance
+
+      kept = matched[~moved]
+      added = np.flatnonzero(same_id)[moved]
+      added = np.concatenate([added, np.flatnonzero(~same_id)])
+      removed = np.setdiff1d(slots, kept)
+      return kept, removed, np.sort(added), int(moved.sum()), "id"
+
+    # Without ids, a tree is the same tree if there is one within match_distance of it in the other survey
+    new_index = SpatialIndex(points, cell_size=self.precision)
+    old_found = new_index.any_within_many(self.points[slots], self.match_distance)
+    new_found = self._any_tree_within(points, self.match_distance)
+    return slots[old_found], slots[~old_found], np.flatnonzero(~new_found), 0, "position"
+
+  def update(self, trees, survey_id=None):
+    """
+    Bring the state up to date with a new survey of the orchard.
+
+    Parameters:
+    - trees: TreeSet (or an (N, 2) array) of the GPS coordinates (latitude, longitude) of all trees
+             in the new survey, with an `id` attribute if it has tree ids.
+    - survey_id: Optional id of the new survey.
+
+    Returns:
+    - diff: A dictionary summarising what changed: the trees `added`, `removed`, `moved` and
+            `unchanged`, how the trees were `matched_by`, and how many trees, expected locations
+            and clusters had to be checked again. If the survey_id is the same as the last survey's,
+            nothing is checked and the diff is empty.
+    """
+    trees = trees if isinstance(trees, TreeSet) else TreeSet(trees)
+    if survey_id is not None and survey_id == self.survey_id:
+      # The same survey again, so nothing can have changed
+      record_count("trees", len(trees))
+      return {
+        "added": 0,
+        "removed": 0,
+        "moved": 0,
+        "unchanged": int(self.alive.sum()),
+        "matched_by": "survey_id",
+        "trees_rechecked": 0,
+        "locations_changed": 0,
+        "clusters_regrouped": 0,
+      }
+
+    with stage("match"):
+      points = self.projection.to_local(trees)
+      kept, removed, added, moved, matched_by = self._match(trees, points)
+
+    # Remove the trees that are gone, and add the new ones in new slots
+    self.alive[removed] = False
+    new_slots = self.index.insert(points[added])
+    self.alive = np.concatenate([self.alive, np.ones(len(new_slots), dtype=bool)])
+    if self.ids is not None:
+      new_ids = self._tree_ids(trees)
+      self.ids = np.concatenate([self.ids, new_ids[added] if new_ids is not None else np.full(len(added), np.nan)])
+    self.candidate_of_key = np.concatenate([self.candidate_of_key, np.full(4 * len(new_slots), -1, dtype=np.int64)])
+    self.survey_id = survey_id
+
+    # Only trees within reach of a change can have different expected locations
+    changes = np.concatenate([self.points[removed], self.points[new_slots]])
+    _, nearby, _ = self.index.within_many(changes, self.reach)
+    rechecked = np.unique(np.concatenate([nearby, removed, new_slots]))
+
+    with stage("candidates"):
+      removed_candidates = self._remove_candidates(rechecked)
+      added_candidates = self._find_candidates(rechecked)
+    with stage("groups"):
+      stale_clusters, new_clusters = self._group(added_candidates, removed_candidates)
+    record_count("trees", len(trees))
+    record_count("candidates", len(added_candidates))
+
+    return {
+      "added": int(len(added)) - moved,
+      "removed": int(len(removed)) - moved,
+      "moved": moved,
+      "unchanged": int(len(kept)),
+      "matched_by": matched_by,
+      "trees_rechecked": int(self.alive[rechecked].sum()),
+      "locations_changed": int(len(removed_candidates) + len(added_candidates)),
+      "clusters_regrouped": new_clusters,
+    }
+
+  def missing_tree_coords(self):
+    """
+    Get the missing trees of the orchard as it was last surveyed.
+
+    Returns:
+    - missing_tree_coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+    """
+    centres = sorted(self.centres.values(), key=lambda centre: centre[0])
+    return self.projection.to_latlng(as_coords([centre for _, centre in centres]))
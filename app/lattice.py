@@ -0,0 +1,214 @@
+import numpy as np
+from app.geodesy import as_coords
+from app.metrics import record_count, stage
+from app.orchard_utils import get_orchard_features
+from app.projection import LocalProjection, calculate_next_points, euclidean_distances
+from app.spatial_index import SpatialIndex
+
+# Limits on how well a lattice has to fit an orchard for its empty cells to be trusted
+MIN_ON_LATTICE_FRACTION = 0.95
+MAX_SHARED_CELL_FRACTION = 0.02
+MAX_EMPTY_CELL_FRACTION = 0.2
+
+
+def lattice_basis(orchard_features):
+  """
+  Get the step between neighbouring trees along each major axis of an orchard.
+
+  Parameters:
+  - orchard_features: The major axes of the orchard, as returned by get_orchard_features.
+
+  Returns:
+  - basis: (2, 2) array whose rows are the (north, east) steps along each axis, in meters.
+  """
+  return np.concatenate([
+    calculate_next_points([(0.0, 0.0)], feature["slope"], feature["dist"]) for feature in orchard_features])
+
+
+def snap_to_lattice(points, origin, basis):
+  """
+  Snap points to the nearest cells of a lattice.
+
+  Parameters:
+  - points: (N, 2) array of (north, east) points, in meters.
+  - origin: The (north, east) point of lattice cell (0, 0).
+  - basis: (2, 2) array of the steps along each axis of the lattice, as returned by lattice_basis.
+
+  Returns:
+  - cells: (N, 2) integer array of the lattice cell of each point.
+  - errors: (N,) array of the distance in meters from each point to the centre of its cell.
+  """
+  cells = np.rint(np.linalg.solve(basis.T, (as_coords(points) - origin).T).T).astype(np.int64)
+  return cells, euclidean_distances(points, origin + cells @ basis)
+
+
+def fit_lattice(points, orchard_features, precision=2.5):
+  """
+  Fit a lattice of trees to an orchard.
+
+  The lattice starts from the tree nearest the middle of the orchard, using the average slope and
+  spacing of each axis. Small errors in the spacing add up over long rows, so the lattice is fitted
+  over a neighbourhood of the starting tree first, and refitted by least squares over twice the
+  distance each round until it covers the orchard. Only trees within `precision` of their cell are
+  used to fit it.
+
+  Parameters:
+  - points: (N, 2) array of (north, east) points of all trees, in meters.
+  - orchard_features: The major axes of the orchard, as returned by get_orchard_features.
+  - precision: How close a tree should be to a cell to count as being on the lattice.
+
+  Returns:
+  - origin: The (north, east) point of lattice cell (0, 0).
+  - basis: (2, 2) array of the steps along each axis of the lattice.
+  """
+  basis = lattice_basis(orchard_features)
+  origin = points[np.argmin(euclidean_distances(points, points.mean(axis=0)))]
+  distances = euclidean_distances(points, origin)
+  radius = 10 * np.abs(basis).max()
+
+  while True:
+    nearby = points[distances <= radius]
+    cells, errors = snap_to_lattice(nearby, origin, basis)
+    on_lattice = errors <= precision
+    design = np.column_stack([cells[on_lattice], np.ones(on_lattice.sum())])
+    if np.linalg.matrix_rank(design) == 3:
+      fit = np.linalg.lstsq(design, nearby[on_lattice], rcond=None)[0]
+      basis, origin = fit[:2], fit[2]
+    if radius >= distances.max():
+      return origin, basis
+    radius *= 2
+
+
+def find_empty_cells(cells):
+  """
+  Find the cells of a lattice inside an orchard that have no tree.
+
+  A cell is inside the orchard if there are trees on both sides of it along its row, and on both
+  sides of it along its column. This follows the edges of the orchard without needing a convex
+  hull, so notches cut into the side of a block are not reported.
+
+  Parameters:
+  - cells: (N, 2) integer array of the lattice cells that have a tree.
+
+  Returns:
+  - empty_cells: (M, 2) integer array of the cells inside the orchard without a tree, ordered by
+                 row then column.
+  """
+  cells = np.unique(cells, axis=0)
+  if not len(cells):
+    return cells
+
+  def spans(axis):
+    # Lowest and highest cell along the other axis, for every line of cells along this axis
+    ordered = cells[np.lexsort((cells[:, 1 - axis], cells[:, axis]))]
+    lines, first = np.unique(ordered[:, axis], return_index=True)
+    last = np.r_[first[1:], len(ordered)] - 1
+    return lines, ordered[first, 1 - axis], ordered[last, 1 - axis]
+
+  rows, row_start, row_end = spans(0)
+  columns, column_start, column_end = spans(1)
+
+  # Every cell between the ends of each row, skipping the ones with trees
+  lengths = row_end - row_start + 1
+  candidates = np.column_stack([
+    np.repeat(rows, lengths),
+    np.repeat(row_start - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum()),
+  ])
+  width = columns[-1] - columns[0] + 1
+  empty = ~np.isin(candidates[:, 0] * width + candidates[:, 1], cells[:, 0] * width + cells[:, 1])
+
+  # Of those, keep the cells that are also between the ends of their column
+  column = np.minimum(np.searchsorted(columns, candidates[:, 1]), len(columns) - 1)
+  inside = (
+    (columns[column] == candidates[:, 1])
+    & (candidates[:, 0] > column_start[column])
+    & (candidates[:, 0] < column_end[column])
+  )
+  return candidates[empty & inside]
+
+
+def check_lattice_fit(cells, on_lattice, empty_cells):
+  """
+  Check that a lattice fits an orchard well enough for its empty cells to be reported.
+
+  When the orchard features are wrong, the lattice still covers the orchard, but at the wrong
+  angle or spacing, so many trees fall between cells or share one, and many cells are empty.
+
+  Parameters:
+  - cells: (N, 2) integer array of the lattice cell of every tree.
+  - on_lattice: (N,) boolean array of whether each tree is within `precision` of its cell.
+  - empty_cells: (M, 2) integer array of the empty cells inside the orchard, from find_empty_cells.
+
+  Raises:
+  - ValueError: If too few trees are on the lattice, too many cells hold several trees, or too many
+                cells inside the orchard are empty.
+  """
+  _, trees_per_cell = np.unique(cells[on_lattice], axis=0, return_counts=True)
+  on_lattice_fraction = on_lattice.mean() if len(on_lattice) else 0.0
+  shared_cell_fraction = (trees_per_cell > 1).mean() if len(trees_per_cell) else 0.0
+  empty_cell_fraction = len(empty_cells) / max(len(empty_cells) + len(trees_per_cell), 1)
+  if on_lattice_fraction < MIN_ON_LATTICE_FRACTION:
+    raise ValueError(f"The orchard does not fit a lattice: only {on_lattice_fraction:.0%} of trees are on it")
+  if shared_cell_fraction > MAX_SHARED_CELL_FRACTION:
+    raise ValueError(f"The orchard does not fit a lattice: {shared_cell_fraction:.0%} of its cells hold several trees")
+  if empty_cell_fraction > MAX_EMPTY_CELL_FRACTION:
+    raise ValueError(f"The orchard does not fit a lattice: {empty_cell_fraction:.0%} of its cells are empty")
+
+
+def detect_missing_trees_lattice(all_trees, min_group_size=3, precision=2.5, feature_tolerance=None):
+  """
+  Find the missing trees in an orchard by fitting a lattice to it.
+
+  This is an alternative to detect_missing_trees. Instead of every tree checking where its
+  neighbours should be, the orchard features are used to fit one lattice to the whole orchard,
+  every tree is snapped to its lattice cell in a single vectorised pass, and the empty cells inside
+  the orchard are reported as missing trees. Runs of missing trees are found in the same pass, as
+  each empty cell is reported on its own.
+
+  Parameters:
+  - all_trees: TreeSet (or an (N, 2) array) of GPS coordinates (latitude, longitude) of all trees.
+  - min_group_size: Not used, as an empty cell does not rely on its neighbours to be found. It is
+                    accepted so that both detectors can be called the same way.
+  - precision: How close a tree should be to a lattice cell to count as being in it, in meters.
+  - feature_tolerance: Optional distance in meters to sample the orchard features to (see
+                       get_orchard_features). By default every tree is used.
+
+  Returns:
+  - missing_tree_coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+
+  Raises:
+  - ValueError: If the lattice does not fit the orchard (see check_lattice_fit).
+  """
+  with stage("index"):
+    projection = LocalProjection(all_trees)
+    tree_points = projection.to_local(all_trees)
+    index = SpatialIndex(tree_points, cell_size=precision)
+
+  with stage("features"):
+    features = get_orchard_features(tree_points, index, feature_tolerance)
+
+  with stage("fit_lattice"):
+    origin, basis = fit_lattice(tree_points, features, precision)
+    cells, errors = snap_to_lattice(tree_points, origin, basis)
+
+  with stage("empty_cells"):
+    on_lattice = errors <= precision
+    empty_cells = find_empty_cells(cells[on_lattice])
+    check_lattice_fit(cells, on_lattice, empty_cells)
+
+  record_count("trees", len(tree_points))
+  record_count("missing_trees", len(empty_cells))
+  return projection.to_latlng(origin + empty_cells @ basis)
+
+
+def detect_missing_trees_lattice_converged(all_trees, min_group_size=3, precision=2.5, feature_tolerance=None,
+                                           max_iterations=10):
+  """
+  The converging form of detect_missing_trees_lattice. Every empty cell is found in the first pass,
+  so this always takes a single iteration.
+
+  Returns:
+  - missing_tree_coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+  - iterations: The number of passes run, which is always 1.
+  """
+  return detect_missing_trees_lattice(all_trees, min_group_size, precision, feature_tolerance), 1
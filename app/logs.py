@@ -0,0 +1,144 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+# Attributes that every LogRecord has, so anything else on a record was passed in `extra`
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as one line of JSON, with the time, level, logger and message, and any
+    fields passed in `extra` when it was logged.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((name, value) for name, value in vars(record).items() if name not in RECORD_ATTRIBUTES)
+        entry.pop("sampled", None)
+        # uvicorn adds a copy of its message with terminal colours
+        entry.pop("color_message", None)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records logged with `extra={"sampled": True}`, such as a line for
+    every request, so that they cannot flood the logs under load. Every other record is kept.
+    """
+
+    def __init__(self, rate=1.0, random=random.random):
+        """
+        Create the filter.
+
+        Parameters:
+        - rate: The fraction of sampled records to keep, from 0 (none) to 1 (all of them).
+        - random: Function returning a random number in [0, 1).
+        """
+        super().__init__()
+        self.rate = rate
+        self.random = random
+        self.dropped = 0
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False) or self.rate >= 1 or self.random() < self.rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class MarkSampled(logging.Filter):
+    """
+    Marks every record of a logger as sampled, for loggers that cannot pass `extra` themselves, such
+    as the access log of the server.
+    """
+
+    def filter(self, record):
+        record.sampled = True
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that leaves formatting to the listener's thread.
+
+    The standard QueueHandler formats each message before queueing it, which would still put the
+    cost of formatting large payloads on the thread that logged them. Records are only copied here,
+    so the arguments of a record must not be changed after it is logged.
+    """
+
+    def prepare(self, record):
+        return logging.makeLogRecord(vars(record))
+
+
+class QueuedLogging:
+    """
+    Loggers that log through a queue, and the listener that writes their records, as set up by
+    setup_logging.
+    """
+
+    def __init__(self, loggers, handler, output, listener):
+        self.loggers = loggers
+        self.handler = handler
+        self.output = output
+        self.listener = listener
+
+    def stop(self):
+        """
+        Point the loggers straight at the stream, then stop the listener once it has written the
+        records still in the queue. Anything logged while the server finishes shutting down, such as
+        uvicorn's last lines, is then still written.
+        """
+        for log_filter in self.handler.filters:
+            self.output.addFilter(log_filter)
+        for logger in self.loggers:
+            logger.handlers = [self.output]
+        self.listener.stop()
+
+
+def setup_logging(names=("app",), level="INFO", sample_rate=1.0, stream=None, sampled=()):
+    """
+    Send the logs of some loggers through one queue, to be formatted as JSON and written to a stream
+    by a background thread, so that a slow stream never holds up the code that logged them.
+
+    Parameters:
+    - names: The names of the loggers to set up. Loggers below them (such as app.main) log through them.
+    - level: The lowest level that is logged, such as 'DEBUG' or 'INFO'.
+    - sample_rate: The fraction of sampled records (see SamplingFilter) to keep.
+    - stream: The stream to write to. Defaults to stdout.
+    - sampled: The names of loggers whose every record is sampled, such as 'uvicorn.access'.
+
+    Returns:
+    - logging: The QueuedLogging of the loggers. Stop it when the server shuts down, to write any
+               records still in the queue.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(sample_rate))
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+
+    loggers = [logging.getLogger(name) for name in names]
+    for logger in loggers:
+        logger.setLevel(level)
+        logger.handlers = [handler]
+        logger.propagate = False
+    for name in sampled:
+        logger = logging.getLogger(name)
+        if not any(isinstance(existing, MarkSampled) for existing in logger.filters):
+            logger.addFilter(MarkSampled())
+
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    return QueuedLogging(loggers, handler, output, listener)
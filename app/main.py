@@ -1,80 +1,442 @@
-import markdown
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
-import requests
+import asyncio
+import json
+import logging
+from contextlib import contextmanager
+from enum import Enum
+from typing import List, Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+import httpx
 import os
-from app.orchard_utils import *
+from app.cache import LRUCache
+from app.detection_pool import DetectionPool, DetectionPoolBusy
+from app.logs import setup_logging
+from app.metrics import COUNT_BUCKETS, MetricsRegistry, StageRecorder, measured, merge, recording, stage
+from app.serialisation import MEDIA_TYPES, missing_trees_json, missing_trees_response, negotiate_media_type
+from app.single_flight import SingleFlight
+from app.static_content import CachedStaticFiles, LandingPage
+from app.survey_store import SurveyStore
+from app.tree_set import TREE_ATTRIBUTES
+from app.upstream import AeroboticsClient
 
 app = FastAPI()
-app.mount("/assets", StaticFiles(directory="assets"), name="assets")
+logger = logging.getLogger(__name__)
 
-base_url = "https://sherlock.aerobotics.com/developers"
+# Logs, including uvicorn's, are written as JSON lines from a background thread. Full responses are only
+# logged at DEBUG, and only LOG_SAMPLE_RATE of the per-orchard request lines and access log lines are kept.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 1.0))
+
+base_url = os.getenv('AEROBOTICS_BASE_URL', "https://sherlock.aerobotics.com/developers")
 API_KEY = os.getenv('API_KEY')
 HOST_NAME = os.getenv('HOSTNAME')
 
+# The README is rendered once (and again only if it changes), and the images it links to can be
+# kept by clients for ASSETS_MAX_AGE seconds
+ASSETS_MAX_AGE = int(os.getenv('ASSETS_MAX_AGE', 86400))
+landing_page = LandingPage('./README.md', host_name=HOST_NAME)
+app.mount("/assets", CachedStaticFiles(directory="assets", max_age=ASSETS_MAX_AGE), name="assets")
+
+# Upstream connection settings
+UPSTREAM_TIMEOUT = float(os.getenv('UPSTREAM_TIMEOUT', 10))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 5))
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv('UPSTREAM_MAX_CONNECTIONS', 100))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv('UPSTREAM_MAX_KEEPALIVE', 20))
+UPSTREAM_RETRIES = int(os.getenv('UPSTREAM_RETRIES', 3))
+UPSTREAM_BACKOFF = float(os.getenv('UPSTREAM_BACKOFF', 0.5))
+UPSTREAM_MAX_PAGES_IN_FLIGHT = int(os.getenv('UPSTREAM_MAX_PAGES_IN_FLIGHT', 8))
+
+# Detection parameters
+MIN_GROUP_SIZE = 3
+PRECISION = 2.5
+# The orchard features are estimated from random trees until they place the next tree to within this
+# many meters. FEATURE_TOLERANCE=0 uses every tree instead.
+FEATURE_TOLERANCE = float(os.getenv('FEATURE_TOLERANCE', 0.01)) or None
+
+# Parsed surveys are cached per orchard for a while, since they only change a few times a season.
+# Detection results are cached per survey and detection parameters, so they never go stale.
+SURVEY_CACHE_SIZE = int(os.getenv('SURVEY_CACHE_SIZE', 256))
+SURVEY_CACHE_TTL = float(os.getenv('SURVEY_CACHE_TTL', 900))
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 1024))
+survey_cache = LRUCache(max_size=SURVEY_CACHE_SIZE, ttl=SURVEY_CACHE_TTL)
+result_cache = LRUCache(max_size=RESULT_CACHE_SIZE)
+# The detection state of the last survey of each orchard is kept for incremental requests, so that a
+# new survey only has to be checked where it changed
+ORCHARD_STATE_CACHE_SIZE = int(os.getenv('ORCHARD_STATE_CACHE_SIZE', 64))
+orchard_states = LRUCache(max_size=ORCHARD_STATE_CACHE_SIZE)
+# Fetched surveys are also saved to disk when SURVEY_STORE_DIR is set, so they survive restarts and
+# recorded surveys can be replayed without the network. SURVEY_STORE_TTL=0 never lets them go stale.
+SURVEY_STORE_DIR = os.getenv('SURVEY_STORE_DIR')
+SURVEY_STORE_TTL = float(os.getenv('SURVEY_STORE_TTL', SURVEY_CACHE_TTL)) or None
+survey_store = SurveyStore(SURVEY_STORE_DIR, ttl=SURVEY_STORE_TTL) if SURVEY_STORE_DIR else None
+
+# Detection of large orchards runs in a pool of worker processes. DETECTION_WORKERS=0 disables
+# the pool and runs every orchard in the threadpool.
+DETECTION_WORKERS = int(os.getenv('DETECTION_WORKERS', os.cpu_count() or 1))
+DETECTION_MAX_PENDING = int(os.getenv('DETECTION_MAX_PENDING', 2 * max(DETECTION_WORKERS, 1)))
+DETECTION_INLINE_MAX_TREES = int(os.getenv('DETECTION_INLINE_MAX_TREES', 2000))
+# Very large orchards are split into tiles of this many meters, which are spread over the workers
+DETECTION_TILE_MIN_TREES = int(os.getenv('DETECTION_TILE_MIN_TREES', 50000))
+DETECTION_TILE_SIZE = float(os.getenv('DETECTION_TILE_SIZE', 250))
+
+# The most orchards of a batch request that are fetched and processed at once
+BATCH_MAX_IN_FLIGHT = int(os.getenv('BATCH_MAX_IN_FLIGHT', 16))
+
+# Concurrent requests for the same orchard and detection parameters share a single computation
+orchard_flights = SingleFlight()
+
+# The time spent in each stage of processing every orchard, how many trees it had, and the counters
+# of the caches, upstream client and detection pool are exported at /metrics
+metrics = MetricsRegistry()
+orchard_requests = metrics.counter(
+    "orchard_requests_total", "Orchards processed, by endpoint and status code", ("endpoint", "status"))
+stage_seconds = metrics.histogram(
+    "orchard_stage_seconds", "Seconds spent in each stage of processing an orchard", ("stage",))
+orchard_counts = {
+    name: metrics.histogram(f"orchard_{name}", documentation, buckets=COUNT_BUCKETS)
+    for name, documentation in (
+        ("trees", "Trees in each orchard processed"),
+        ("candidates", "Expected tree locations without a tree in each orchard processed"),
+        ("missing_trees", "Missing trees found in each orchard processed"),
+        ("tiles", "Tiles each tiled orchard was split into"),
+    )
+}
+
+@app.on_event("startup")
+def start_logging():
+    # uvicorn.error logs through uvicorn, so these cover every logger of the server
+    app.state.queued_logging = setup_logging(
+        ("app", "uvicorn", "uvicorn.access"), level=LOG_LEVEL, sample_rate=LOG_SAMPLE_RATE, sampled=("uvicorn.access",))
+
+@app.on_event("startup")
+async def open_upstream_client():
+    app.state.aerobotics = AeroboticsClient(
+        base_url,
+        API_KEY,
+        timeout=UPSTREAM_TIMEOUT,
+        connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+        retries=UPSTREAM_RETRIES,
+        backoff=UPSTREAM_BACKOFF,
+        max_pages_in_flight=UPSTREAM_MAX_PAGES_IN_FLIGHT)
+
+@app.on_event("startup")
+def start_detection_pool():
+    app.state.detection_pool = DetectionPool(
+        workers=DETECTION_WORKERS,
+        max_pending=DETECTION_MAX_PENDING,
+        inline_max_trees=DETECTION_INLINE_MAX_TREES,
+        tile_min_trees=DETECTION_TILE_MIN_TREES,
+        tile_size=DETECTION_TILE_SIZE)
+
+@app.on_event("shutdown")
+async def close_upstream_client():
+    await app.state.aerobotics.aclose()
+
+@app.on_event("shutdown")
+def stop_detection_pool():
+    app.state.detection_pool.shutdown()
+
+@app.on_event("shutdown")
+def stop_logging():
+    app.state.queued_logging.stop()
+
 @app.get("/")
-def read_root():
-    
-    with open('./README.md', 'r') as file:
-      readme_md = file.read()
+def read_root(request: Request):
+    return landing_page.response(request.headers)
 
-    # Convert the input to HTML
-    readme = markdown.markdown(readme_md)
+class Engine(str, Enum):
+    """
+    The missing tree detectors. `neighbours` checks where the neighbours of every tree should be,
+    and `lattice` fits one lattice to the whole orchard and reports its empty cells.
+    """
+    neighbours = "neighbours"
+    lattice = "lattice"
 
-    html_content = f"""
-    <html>
-        <head>
-            <title>Aerobotics Assignment</title>
-        </head>
-        <body>
-            {readme}
-        </body>
-    </html>
+class WireFormat(str, Enum):
+    """
+    The formats missing trees can be returned in (see app.serialisation).
     """
+    json = "json"
+    geojson = "geojson"
+    columnar = "columnar"
 
-    img_str = f"![img](http://{HOST_NAME}:8000/"
-    html_content = html_content.replace("![img](", img_str)
+@app.get("/orchards/{orchard_id}/missing-trees")
+async def orchard_missing_trees(orchard_id: int, request: Request, engine: Engine = Engine.neighbours,
+                                converge: bool = False, incremental: bool = False, profile: bool = False,
+                                format: Optional[WireFormat] = None):
+    """
+    Find the missing trees in an orchard. With `converge`, the missing trees found are added back into
+    the orchard and searched again until no new ones are found, and the number of `iterations` is returned.
 
-    return HTMLResponse(content=html_content, status_code=200)
+    With `incremental`, the detection state of the orchard is kept, and a new survey of it is only
+    checked where trees were added, removed or moved since the last one. A `diff` of the surveys is
+    returned, which is null the first time the orchard is seen.
 
-@app.get("/orchards/{orchard_id}/missing-trees")
-def orchard_missing_trees(orchard_id: int):
+    With `profile`, the time spent in each stage of handling the request is returned in a
+    Server-Timing header, in milliseconds.
 
-    # Print to stdout instead of logging for now
-    print(f"Requst to find missing trees in orchard {orchard_id}")
+    The missing trees are returned as JSON by default, or as a GeoJSON MultiPoint feature, or as
+    columnar float64 arrays, chosen by `format` or else by the Accept header. They are gzipped if
+    the client accepts it.
+    """
+    media_type = MEDIA_TYPES[format.value] if format is not None else negotiate_media_type(
+        request.headers.get("accept"))
+    if media_type is None:
+        raise HTTPException(
+            status_code=406, detail=f"Missing trees can only be returned as {', '.join(MEDIA_TYPES.values())}")
 
-    survey_content = call_aerobotics_api(path="treesurveys/", params={"survey__orchard_id": orchard_id})
-    
-    print("Retrieved latest orchard survey")
+    logger.debug("Finding missing trees", extra={"orchard_id": orchard_id, "engine": engine.value})
 
-    results = survey_content.json()['results']
-    all_trees = [(float(s['latitude']), float(s['longitude'])) for s in results]
+    with observe_orchard("orchard") as recorder:
+        if incremental:
+            if engine is not Engine.neighbours or converge:
+                raise HTTPException(
+                    status_code=422, detail="Incremental detection only supports the neighbours engine, without converge")
+            missing_tree_coords, diff = await orchard_flights.run(
+                (orchard_id, "incremental", MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE),
+                find_orchard_missing_trees_incremental, orchard_id)
+            fields = {"orchard_id": orchard_id, "diff": diff}
+        else:
+            missing_tree_coords, iterations = await orchard_flights.run(
+                (orchard_id, engine, converge, MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE),
+                find_orchard_missing_trees, orchard_id, engine, converge)
+            fields = missing_trees_fields(orchard_id, iterations)
 
-    # Get slope and distance between trees on both axes in the orchard
-    features = get_orchard_features(all_trees)
+    response = missing_trees_response(
+        fields, missing_tree_coords, media_type, request.headers.get("accept-encoding"),
+        headers={"Server-Timing": recorder.server_timing()} if profile else None)
 
-    # Find missing trees
-    missing_trees = find_missing_trees(all_trees, features)
+    logger.info("Found missing trees", extra={
+        "orchard_id": orchard_id,
+        "engine": engine.value,
+        "converge": converge,
+        "incremental": incremental,
+        "missing_trees": len(missing_tree_coords),
+        "duration_ms": round(recorder.stages["total"] * 1000, 3),
+        "sampled": True,
+    })
+    if logger.isEnabledFor(logging.DEBUG):
+        # Only build the list of every missing tree when it will be logged
+        logger.debug("Missing trees response", extra={**fields, "missing_trees": missing_tree_coords.tolist()})
 
-    # Group missing trees
-    missing_tree_groups = find_tree_groups(missing_trees, min_group_size=3, precision=2.5)
+    return response
 
-    # Find average loc of missing trees
-    missing_tree_coords = [find_center_coord(missing_tree_group) for missing_tree_group in missing_tree_groups]
+class OrchardBatch(BaseModel):
+    orchard_ids: List[int]
+    engine: Engine = Engine.neighbours
+    converge: bool = False
 
-    response = {
-        "orchard_id": orchard_id,
-        "missing_trees": [{"lat":lat,"lng":lng} for lat,lng in missing_tree_coords]
+@app.post("/orchards/missing-trees")
+async def batch_orchard_missing_trees(batch: OrchardBatch):
+    """
+    Find the missing trees in many orchards. The result of each orchard is streamed back as a line
+    of JSON as soon as it is ready, so the lines are not in the order of the request. Orchards that
+    fail have an `error` instead of `missing_trees`, and do not affect the rest of the batch.
+    """
+    logger.info("Finding missing trees in a batch", extra={"orchards": len(batch.orchard_ids), "engine": batch.engine.value})
+
+    return StreamingResponse(stream_orchard_missing_trees(batch.orchard_ids, batch.engine, batch.converge), media_type="application/x-ndjson")
+
+async def stream_orchard_missing_trees(orchard_ids: List[int], engine: Engine = Engine.neighbours,
+                                       converge: bool = False):
+    in_flight = asyncio.Semaphore(BATCH_MAX_IN_FLIGHT)
+
+    async def process(orchard_id):
+        async with in_flight:
+            try:
+                with observe_orchard("batch"):
+                    # Batches wait for space in the detection pool, rather than being turned away
+                    missing_tree_coords, iterations = await orchard_flights.run(
+                        (orchard_id, engine, converge, MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE, "batch"),
+                        find_orchard_missing_trees, orchard_id, engine, converge, wait_for_pool=True)
+            except HTTPException as e:
+                error = {"status_code": e.status_code, "detail": e.detail}
+                return json.dumps({"orchard_id": orchard_id, "error": error}).encode()
+            except Exception as e:
+                return json.dumps({"orchard_id": orchard_id, "error": {"status_code": 500, "detail": str(e)}}).encode()
+            return missing_trees_json(missing_trees_fields(orchard_id, iterations), missing_tree_coords)
+
+    # Each orchard is only processed once, even if it is requested more than once
+    tasks = [asyncio.ensure_future(process(orchard_id)) for orchard_id in dict.fromkeys(orchard_ids)]
+    try:
+        for result in asyncio.as_completed(tasks):
+            yield await result + b"\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def missing_trees_fields(orchard_id, iterations=None):
+    """
+    The fields of a missing trees response, other than the missing trees, which are serialised
+    separately (see app.serialisation).
+    """
+    fields = {"orchard_id": orchard_id}
+    if iterations is not None:
+        fields["iterations"] = iterations
+    return fields
+
+@app.get("/stats")
+def stats():
+    return {
+        "caches": {"surveys": survey_cache.stats(), "results": result_cache.stats(), "states": orchard_states.stats()},
+        "coalescing": orchard_flights.stats(),
+        "detection": app.state.detection_pool.stats(),
+        "store": survey_store.stats() if survey_store is not None else None,
+        "upstream": app.state.aerobotics.stats(),
         }
 
-    print(f"Response: {response}")
+@app.get("/metrics")
+def read_metrics():
+    """
+    The metrics of the server, in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    return response
+@contextmanager
+def observe_orchard(endpoint):
+    """
+    Record the stages of processing an orchard, and add them to the metrics once it is done.
+    """
+    recorder = StageRecorder()
+    status = 500
+    try:
+        with recording(recorder), stage("total"):
+            yield recorder
+        status = 200
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    finally:
+        orchard_requests.inc(endpoint=endpoint, status=status)
+        for name, seconds in recorder.stages.items():
+            stage_seconds.observe(seconds, stage=name)
+        for name, value in recorder.counts.items():
+            if name in orchard_counts:
+                orchard_counts[name].observe(value)
+
+def stats_metrics(prefix, components, counters={}, gauges={}, label=None):
+    """
+    Turn the stats of components into metric families, one for each field described in `counters`
+    and `gauges`, with a sample for each component labelled by its name (or a single unlabelled
+    sample, if there is no label).
+    """
+    for fields, kind, suffix in ((counters, "counter", "_total"), (gauges, "gauge", "")):
+        for field, documentation in fields.items():
+            samples = [({label: name} if label else {}, stats[field]) for name, stats in components.items()]
+            yield f"{prefix}_{field}{suffix}", kind, documentation, samples
+
+@metrics.collector
+def collect_stats():
+    caches = {"surveys": survey_cache.stats(), "results": result_cache.stats(), "states": orchard_states.stats()}
+    yield from stats_metrics("cache", caches, label="cache", counters={
+        "hits": "Lookups that found a value in each cache",
+        "misses": "Lookups that found nothing in each cache",
+        "evictions": "Values dropped from each cache to make space",
+        "expiries": "Values dropped from each cache because they were too old",
+    }, gauges={"size": "Values held by each cache"})
+    if survey_store is not None:
+        yield from stats_metrics("survey_store", {"store": survey_store.stats()}, counters={
+            "hits": "Surveys loaded from the survey store",
+            "misses": "Lookups of orchards that are not in the survey store",
+            "stale": "Lookups of surveys in the survey store that were too old",
+        }, gauges={"size": "Orchards in the survey store"})
+    yield from stats_metrics("coalescing", {"flights": orchard_flights.stats()}, counters={
+        "leaders": "Calls started for an orchard",
+        "coalesced": "Callers that shared a call already running for an orchard",
+    }, gauges={
+        "in_flight": "Calls running",
+        "waiting": "Callers waiting on a call started by another",
+    })
+    yield from stats_metrics("detection_pool", {"pool": app.state.detection_pool.stats()}, counters={
+        "pooled": "Orchards run in the worker processes",
+        "inline": "Orchards run in the threadpool",
+        "tiled": "Orchards split into tiles",
+        "rejected": "Orchards turned away because the pool was full",
+    }, gauges={"pending": "Orchards running or queued in the worker processes"})
+    yield from stats_metrics("upstream", {"client": app.state.aerobotics.stats()}, counters={
+        "requests": "Requests made to the Aerobotics API, including retries",
+        "retried": "Requests to the Aerobotics API that were retried",
+        "failures": "Calls to the Aerobotics API that failed after every retry",
+        "pages": "Survey pages parsed",
+        "bytes": "Bytes of survey pages read",
+    })
+
+async def find_orchard_missing_trees(orchard_id: int, engine: Engine = Engine.neighbours, converge: bool = False,
+                                     wait_for_pool: bool = False):
+    """
+    Returns the missing tree coordinates, and the number of passes if converging (otherwise None).
+    """
+    survey = await get_orchard_survey(orchard_id)
+    logger.debug("Retrieved latest orchard survey", extra={
+        "orchard_id": orchard_id, "survey_id": survey["survey_id"], "trees": len(survey["trees"])})
+
+    result_key = (survey["survey_id"], engine, converge, MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE)
+    result = result_cache.get(result_key)
+    if result is None:
+        # Run the CPU bound detection off the event loop, so other requests are not held up. Batches
+        # wait for the pool, and send it every orchard so that they run in parallel across cores.
+        try:
+            result = await app.state.detection_pool.run(
+                survey["trees"], MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE, engine=engine.value, converge=converge,
+                wait=wait_for_pool, inline=not wait_for_pool)
+        except DetectionPoolBusy as e:
+            raise HTTPException(status_code=503, detail=f"Too many orchards are being processed: {e}",
+                                headers={"Retry-After": "1"})
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=f"Could not find the missing trees in the orchard: {e}")
+        if not converge:
+            result = (result, None)
+        if survey["survey_id"] is not None:
+            result_cache.set(result_key, result)
+    return result
+
+async def find_orchard_missing_trees_incremental(orchard_id: int):
+    """
+    Returns the missing tree coordinates, and the diff from the last survey of the orchard (or None).
+    """
+    survey = await get_orchard_survey(orchard_id)
+
+    # The state is built by the detection pool, as that runs the full pipeline. It lives in this process
+    # afterwards, so the (much smaller) updates are run in the threadpool.
+    state_key = (orchard_id, MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE)
+    state = orchard_states.get(state_key)
+    try:
+        if state is None:
+            state = await app.state.detection_pool.build_state(
+                survey["trees"], MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE, survey["survey_id"])
+            orchard_states.set(state_key, state)
+            diff = None
+        else:
+            diff = merge(await run_in_threadpool(measured, state.update, survey["trees"], survey["survey_id"]))
+    except DetectionPoolBusy as e:
+        raise HTTPException(status_code=503, detail=f"Too many orchards are being processed: {e}",
+                            headers={"Retry-After": "1"})
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Could not find the missing trees in the orchard: {e}")
+    return state.missing_tree_coords(), diff
+
+async def get_orchard_survey(orchard_id: int):
+    survey = survey_cache.get(orchard_id)
+    if survey is None and survey_store is not None:
+        with stage("store"):
+            survey = survey_store.get(orchard_id)
+        if survey is not None:
+            survey_cache.set(orchard_id, survey)
+    if survey is None:
+        try:
+            with stage("upstream"):
+                survey = await call_aerobotics_api(path="treesurveys/", params={"survey__orchard_id": orchard_id})
+        except httpx.HTTPError as e:
+            logger.warning("Could not fetch the orchard survey", extra={"orchard_id": orchard_id, "error": str(e)})
+            raise HTTPException(status_code=502, detail=f"Could not fetch the orchard survey: {e}")
+        survey_cache.set(orchard_id, survey)
+        if survey_store is not None:
+            await run_in_threadpool(survey_store.put, orchard_id, survey)
+    return survey
 
-def call_aerobotics_api(path: str, params: dict): 
-    return requests.get(
-        f"{base_url}/{path}",
-        params=params,
-        headers={"Authorization": API_KEY, 
-                 "accept": "application/json"})
\ No newline at end of file
+async def call_aerobotics_api(path: str, params: dict): 
+    return await app.state.aerobotics.get_survey(path, params=params, fields=TREE_ATTRIBUTES)
\ No newline at end of file
@@ -0,0 +1,239 @@
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the buckets of latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds of the buckets of histograms of how many trees (or locations) were processed
+COUNT_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+
+# The recorder of the request being handled, if any
+_recorder = contextvars.ContextVar("stage_recorder", default=None)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A count that only goes up, such as the number of requests, optionally split by labels.
+    """
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Histogram:
+    """
+    A distribution of observed values, such as latencies, counted into cumulative buckets.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            labels = dict(zip(self.labels, key))
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(float(bound))}, count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, counts[-1]
+
+
+class MetricsRegistry:
+    """
+    A set of metrics that can be rendered in the Prometheus text exposition format.
+
+    Counters and histograms are updated as requests are handled. Values that other components
+    already count, such as the hits of a cache, are read from them by collectors when the metrics
+    are rendered instead, so they are never counted twice.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, function):
+        """
+        Add a function that is called whenever the metrics are rendered. It should return an iterable
+        of (name, type, documentation, samples) tuples, where samples is a list of (labels, value).
+        Can be used as a decorator.
+        """
+        self.collectors.append(function)
+        return function
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+        - text: The metrics, one sample per line.
+        """
+        lines = []
+
+        def family(name, type, documentation, samples):
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {type}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+
+        for metric in self.metrics:
+            family(metric.name, metric.type, metric.documentation, metric.samples())
+        for collector in self.collectors:
+            for name, type, documentation, samples in collector():
+                family(name, type, documentation, ((name, labels, value) for labels, value in samples))
+        return "\n".join(lines) + "\n"
+
+
+class StageRecorder:
+    """
+    The time spent in each stage of handling one request, and how many trees it processed.
+
+    A recorder is made current with `recording`, and the pipeline adds to it with `stage` and
+    `record_count` without it being passed down. Work done in another thread or process is run
+    with `measured`, which sends a recorder of its own back with the result to be merged in.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def merge(self, other):
+        for name, seconds in other.stages.items():
+            self.add(name, seconds)
+        self.counts.update(other.counts)
+
+    def server_timing(self):
+        """
+        Get the stage timings as the value of a Server-Timing header, in milliseconds.
+        """
+        return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.stages.items())
+
+
+@contextmanager
+def recording(recorder):
+    """
+    Make a recorder current for the code inside the block.
+    """
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time the code inside the block as a stage of the current request. Does nothing if no recorder
+    is current.
+    """
+    recorder = _recorder.get()
+    if recorder is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add(name, time.perf_counter() - start)
+
+
+def record_count(name, value):
+    """
+    Record how many of something (such as trees) the current request processed.
+    """
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.counts[name] = int(value)
+
+
+def measured(function, *args, **kwargs):
+    """
+    Run a function with a recorder of its own. Use this to run work in a thread or worker process,
+    where the recorder of the request is not current, and merge the recorder back in with `merge`.
+
+    Returns:
+    - result: What the function returned.
+    - recorder: The StageRecorder of the stages it ran.
+    """
+    recorder = StageRecorder()
+    with recording(recorder):
+        result = function(*args, **kwargs)
+    return result, recorder
+
+
+def merge(outcome):
+    """
+    Merge the recorder returned by `measured` into the current recorder.
+
+    Returns:
+    - result: The result returned by `measured`.
+    """
+    result, recorder = outcome
+    current = _recorder.get()
+    if current is not None:
+        current.merge(recorder)
+    return result
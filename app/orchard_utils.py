@@ -1,58 +1,175 @@
+import math
+import numpy as np
 from app.coord_utils import *
+from app.geodesy import as_coords, are_points_on_lines
+from app.metrics import record_count, stage
+from app.projection import LocalProjection, calculate_next_points, euclidean_distances
+from app.spatial_index import SpatialIndex
+from app.tree_set import TreeSet
 
 
-def find_neighbour_trees(tree, all_trees, num_neighbours=4):
+def find_neighbour_trees(tree, all_trees, num_neighbours=4, index=None):
   """
   Find the closest tree to a target tree in a list.
 
   Parameters:
-  - tree: Tuple (latitude, longitude) for the target tree.
-  - all_trees: List of tuples representing GPS coordinates of all trees.
+  - tree: Tuple (north, east) for the target tree.
+  - all_trees: TreeSet (or a list of tuples) of the locations (north, east) of all trees, in meters.
   - num_neighbours: Number of closest trees to find (default is 4).
+  - index: Optional SpatialIndex built over all_trees. One is built if not given.
 
   Returns:
   - closest: List of the closest tree coordinates to the target tree.
   """
-  distances = [(coord, haversine_distance(coord, tree)) for coord in all_trees if haversine_distance(coord, tree) > 0]
-  distances.sort(key=lambda x: x[1])  # Sort by distance
+  if index is None:
+    index = SpatialIndex(all_trees)
+  return index.nearest_trees(tree, num_neighbours)
 
-  closest = [coord for coord, _ in distances[:num_neighbours]]
-  return closest
-
-def get_orchard_features(all_trees):
+def get_orchard_features(all_trees, index=None, tolerance=None, batch_size=1024, seed=0):
   """
   Find the slope and distance between trees on each major axis of an orchard.
 
+  By default every tree is used. With a `tolerance`, trees are instead drawn at random in batches
+  until the features are known well enough (see sample_orchard_features). The averages settle long
+  before every tree has been used, so this costs about the same for any size of orchard.
+
   Parameters:
-  - all_trees: List of tuples representing GPS coordinates of all trees.
+  - all_trees: TreeSet (or a list of tuples) of the locations (north, east) of all trees, in meters.
+  - index: Optional SpatialIndex built over all_trees, shared with the other stages.
+  - tolerance: Optional distance in meters to sample the features to, or None to use every tree.
+  - batch_size: How many trees to draw at a time when sampling.
+  - seed: Seed for drawing the trees, so that the same orchard always gives the same features.
 
   Returns:
   - features: A list of the major axes of the orchard, each containing a dictionary of the slope
-              and average distance between trees on that axis. 
+              (change in east per meter north) and average distance in meters between trees on that axis. 
   """
 
-  features = []
-  pairs = []
-  for tree in all_trees:
-    neighbours = find_neighbour_trees(tree, all_trees, 4)
-    p, f = get_local_orchard_features(tree, neighbours)
-    features += f
-    pairs += p
-  axis1 = [(slope, dist) for slope, dist in features if slope > 0]
-  axis2 = [(slope, dist) for slope, dist in features if slope < 0]
+  if index is None:
+    index = SpatialIndex(all_trees)
 
-  axis1Slopes, axis1Dists = zip(*axis1)
-  axis2Slopes, axis2Dists = zip(*axis2)
+  if tolerance is None or len(index) <= batch_size:
+    # Find the neighbours of every tree in one batch, and test every pair of them at once
+    all_neighbours = index.nearest_many(all_trees, 4)
+    axes = get_orchard_feature_samples(all_trees, all_neighbours)
+  else:
+    axes = sample_orchard_features(all_trees, index, tolerance, batch_size, seed)
+
+  for axis in axes:
+    if not len(axis["slopes"]):
+      raise ValueError("Could not find trees on both major axes of the orchard")
 
   return [
     {
-      "slope": sum(list(axis1Slopes)) / len(list(axis1Slopes)),
-      "dist" : sum(list(axis1Dists)) / len(list(axis1Dists))
-    },
-    {
-      "slope": sum(list(axis2Slopes)) / len(list(axis2Slopes)),
-      "dist" : sum(list(axis2Dists)) / len(list(axis2Dists))
-    },
+      "slope": float(axis["slopes"].mean()),
+      "dist" : float(axis["dists"].mean())
+    }
+    for axis in axes
+  ]
+
+def sample_orchard_features(all_trees, index, tolerance, batch_size=1024, seed=0, min_samples=30):
+  """
+  Draw slope and distance samples on each major axis of an orchard from random batches of trees,
+  until the averages are known to within a tolerance.
+
+  The running mean and variance of each sample are updated after every batch, and drawing stops
+  once the 95% confidence interval of each axis places the next tree along it to within `tolerance`
+  meters, both along the axis (from the distance) and across it (from the slope). An axis with no
+  samples yet never counts as settled, so if one axis cannot be found, every tree ends up being
+  drawn, and the empty axis is returned just as a full pass would.
+
+  Parameters:
+  - all_trees: TreeSet (or an (N, 2) array) of the locations (north, east) of all trees, in meters.
+  - index: SpatialIndex built over all_trees.
+  - tolerance: How far in meters the next tree along each axis may be off.
+  - batch_size: How many trees to draw at a time.
+  - seed: Seed for drawing the trees.
+  - min_samples: The fewest samples on each axis before the confidence interval is trusted.
+
+  Returns:
+  - axes: A list of the major axes of the orchard, each containing a dictionary of arrays of the slope
+          and distance samples drawn on that axis.
+  """
+  coords = as_coords(all_trees)
+  order = np.random.default_rng(seed).permutation(len(coords))
+  axes = [{"slopes": [], "dists": []}, {"slopes": [], "dists": []}]
+  # Count, mean and sum of squared differences from the mean, of each sample
+  moments = [{"slopes": (0, 0.0, 0.0), "dists": (0, 0.0, 0.0)} for _ in axes]
+
+  for start in range(0, len(order), batch_size):
+    batch = order[start:start + batch_size]
+    batch_axes = get_orchard_feature_samples(coords, index.nearest_many(coords[batch], 4), tree_indices=batch)
+
+    settled = True
+    for axis, batch_axis, axis_moments in zip(axes, batch_axes, moments):
+      half_widths = {}
+      for name, samples in batch_axis.items():
+        axis[name].append(samples)
+        count, mean, m2 = axis_moments[name]
+        if len(samples):
+          # Combine the moments of the batch with the running ones (Chan et al.)
+          batch_mean = samples.mean()
+          delta = batch_mean - mean
+          total = count + len(samples)
+          m2 += ((samples - batch_mean) ** 2).sum() + delta ** 2 * count * len(samples) / total
+          mean += delta * len(samples) / total
+          count = total
+          axis_moments[name] = (count, mean, m2)
+        half_widths[name] = 1.96 * np.sqrt(m2 / (count - 1) / count) if count >= min_samples else np.inf
+
+      # An error in the slope turns the axis, which moves the next tree across it
+      slope, dist = axis_moments["slopes"][1], axis_moments["dists"][1]
+      across = half_widths["slopes"] * abs(dist) / (1 + slope ** 2)
+      settled &= max(half_widths["dists"], across) <= tolerance
+
+    if settled:
+      break
+
+  return [{name: np.concatenate(samples) for name, samples in axis.items()} for axis in axes]
+
+def get_orchard_feature_samples(all_trees, neighbour_indices, precision=0.5, tree_indices=None):
+  """
+  Find the slope and distance samples on each major axis of an orchard, for every tree at once.
+
+  This is the batch form of get_local_orchard_features: for every tree, each pair of its neighbours
+  is checked for whether the tree lies on the line between them, and the first two pairs that it
+  does are kept as samples.
+
+  Parameters:
+  - all_trees: TreeSet (or an (N, 2) array) of the locations (north, east) of all trees, in meters.
+  - neighbour_indices: (N, k) array of the indices of the closest trees to each tree, as returned by
+                       SpatialIndex.nearest_many. Missing neighbours are marked with -1.
+  - precision: How close the slopes should be to count a tree as being on a line.
+  - tree_indices: Optional indices of the trees to sample, if not every tree. neighbour_indices then
+                  has a row for each of these trees.
+
+  Returns:
+  - axes: A list of the major axes of the orchard, each containing a dictionary of arrays of the slope
+          and distance samples on that axis.
+  """
+  coords = as_coords(all_trees)
+  trees = coords if tree_indices is None else coords[tree_indices]
+  if not len(trees):
+    # Without any trees there is nothing to sample, and the neighbours cannot be shaped per tree
+    return [{"slopes": np.empty(0), "dists": np.empty(0)}, {"slopes": np.empty(0), "dists": np.empty(0)}]
+  neighbour_indices = np.asarray(neighbour_indices).reshape(len(trees), -1)
+  first, second = np.triu_indices(neighbour_indices.shape[1], 1)
+
+  t1 = neighbour_indices[:, first]
+  t2 = neighbour_indices[:, second]
+  onLine, slopes, dists = are_points_on_lines(
+    coords[t1].reshape(-1, 2), coords[t2].reshape(-1, 2), np.repeat(trees, len(first), axis=0),
+    precision=precision, distance=euclidean_distances)
+
+  # Keep the first two pairs of neighbours that each tree lies between
+  onLine = onLine.reshape(t1.shape) & (t1 >= 0) & (t2 >= 0)
+  keep = onLine & (np.cumsum(onLine, axis=1) <= 2)
+  slopes = slopes.reshape(t1.shape)[keep]
+  dists = dists.reshape(t1.shape)[keep]
+
+  return [
+    {"slopes": slopes[slopes > 0], "dists": dists[slopes > 0]},
+    {"slopes": slopes[slopes < 0], "dists": dists[slopes < 0]},
   ]
 
 def get_local_orchard_features(tree, neighbours):
@@ -60,8 +177,8 @@ def get_local_orchard_features(tree, neighbours):
   Find the slope and distance between a tree and its neighbours.
 
   Parameters:
-  - tree: A tuple (lat, lng) of a tree
-  - neighbours: List of tuples representing GPS coordinates of neighbour trees.
+  - tree: A tuple (north, east) of a tree
+  - neighbours: List of tuples representing the locations (north, east) of neighbour trees.
 
   Returns:
   - features: A list of tuples representing the slope and average distance between trees on the found
@@ -72,92 +189,360 @@ def get_local_orchard_features(tree, neighbours):
   possible_pairs = [(i, j) for i in range(num_neighbours) for j in range(i, num_neighbours) if i != j]
   pairs = []
   features = []
-  for t1, t2 in possible_pairs:
-    t1_loc = neighbours[t1]
-    t2_loc = neighbours[t2]
+  if not possible_pairs:
+    return (pairs, features)
 
-    onLine, slope, dist = is_point_on_line(t1_loc, t2_loc, tree, precision=0.5)
-    if onLine:
-      pairs.append([t1_loc, t2_loc])
-      features.append((slope, dist))
-      if len(pairs) >= 2: 
-        break
+  # Check every pair at once, and keep the first two that the tree lies between
+  first, second = zip(*possible_pairs)
+  onLine, slopes, dists = are_points_on_lines(
+    [neighbours[t1] for t1 in first], [neighbours[t2] for t2 in second], tree,
+    precision=0.5, distance=euclidean_distances)
+  for p in np.flatnonzero(onLine)[:2]:
+    pairs.append([neighbours[first[p]], neighbours[second[p]]])
+    features.append((float(slopes[p]), float(dists[p])))
 
   return (pairs, features)
 
 
-def is_tree_at_location(check_tree, all_trees, precision):
+def is_tree_at_location(check_tree, all_trees, precision, index=None):
   """
   Check if there is a tree at a given location.
 
   Parameters:
-  - check_tree: A GPS coordinate of a potential tree.
-  - all_trees: List of tuples representing GPS coordinates of all trees.
+  - check_tree: The location (north, east) of a potential tree.
+  - all_trees: TreeSet (or a list of tuples) of the locations (north, east) of all trees, in meters.
   - precision: How close the check_tree should be to an actual tree to confirm that the tree exists.
+  - index: Optional SpatialIndex built over all_trees. If not given, every tree is checked.
 
   Returns:
   - boolean: True if there is a tree at the check_tree location, false otherwise. 
   """
+  if index is not None:
+    return index.any_within(check_tree, precision)
+
   for tree in all_trees: 
-    distance = haversine_distance(tree, check_tree)
+    distance = math.dist(tree, check_tree)
     if distance <= precision: 
       return True
   return False
 
 
-def find_tree_groups(trees, min_group_size, precision):
+def find_tree_clusters(trees, precision):
+  """
+  Cluster trees that are close to each other.
+
+  Two trees are in the same cluster if they are within `precision` of each other, or are
+  linked by a chain of such trees. The trees are indexed once and merged with a union-find,
+  so this runs in roughly linear time. The input is not modified.
+
+  Parameters:
+  - trees: TreeSet (or a list of tuples) of the locations (north, east) of the trees to cluster, in meters.
+  - precision: How close the trees should be to each other to form a cluster.
+
+  Returns:
+  - clusters: A list of dictionaries, each containing the TreeSet of trees in the cluster and the size
+              of the cluster. Clusters are ordered by their first tree in the input, and keep the trees
+              in input order.
+  """
+  trees = trees if isinstance(trees, TreeSet) else TreeSet(trees)
+  if not len(trees):
+    return []
+
+  index = SpatialIndex(trees, cell_size=precision)
+  close_trees, other_trees, _ = index.within_many(trees, precision)
+  clusters = union_find_clusters(len(trees), np.column_stack([close_trees, other_trees]))
+  return [{"trees": trees[members], "size": len(members)} for members in clusters]
+
+
+def union_find_clusters(n, pairs):
+  """
+  Split items into clusters that are linked by pairs, with a union-find.
+
+  Parameters:
+  - n: The number of items.
+  - pairs: (L, 2) integer array of the indices of linked items.
+
+  Returns:
+  - clusters: A list of the index arrays of the items in each cluster. Clusters are ordered by
+              their first item, and keep the items in order.
+  """
+  if not n:
+    return []
+  parents = list(range(n))
+
+  def find(i):
+    while parents[i] != i:
+      parents[i] = parents[parents[i]]
+      i = parents[i]
+    return i
+
+  for i, j in np.asarray(pairs).reshape(-1, 2).tolist():
+    root_i, root_j = find(i), find(j)
+    if root_i != root_j:
+      parents[max(root_i, root_j)] = min(root_i, root_j)
+
+  # Every cluster is rooted at its first item, so sorting by root keeps the clusters in order
+  roots = np.array([find(i) for i in range(n)])
+  order = np.argsort(roots, kind='stable')
+  starts = np.flatnonzero(np.r_[True, roots[order][1:] != roots[order][:-1]])
+  return np.split(order, starts[1:])
+
+
+def find_tree_groups(trees, min_group_size, precision, clusters=None):
   """
   Group sets of trees
 
   Parameters:
-  - all_trees: List of tuples representing GPS coordinates of the trees to group.
+  - trees: TreeSet (or a list of tuples) of the locations (north, east) of the trees to group, in meters.
   - min_group_size: How many trees should be located together to count as a group.
   - precision: How close the trees should be to each other to form a group.
+  - clusters: Optional output of find_tree_clusters for these trees, so that several group sizes
+              can be taken from a single clustering pass.
 
   Returns:
-  - groups: A list of lists of groups of trees (a tuple (lat, lng))
+  - groups: A list of the TreeSets of trees in each group
   """
-  groups = []
-  for check_tree in trees: 
-    temp = [check_tree]
-    for tree in trees:
-      if check_tree != tree:
-        distance = haversine_distance(tree, check_tree)
-        if distance <= precision: 
-          temp.append(tree)
+  if clusters is None:
+    clusters = find_tree_clusters(trees, precision)
+  return [cluster["trees"] for cluster in clusters if cluster["size"] >= min_group_size]
+
+def expected_tree_locations(trees, orchard_features):
+  """
+  Get where the 4 neighbours of every tree should be, one step either way along each major axis.
+
+  Parameters:
+  - trees: TreeSet (or an (N, 2) array) of the locations (north, east) of the trees, in meters.
+  - orchard_features: The major axes of the orchard, as returned by get_orchard_features.
+
+  Returns:
+  - locations: (4N, 2) array of the expected locations, kept in tree order. The location at
+               4 * i + direction was expected from tree i, in that direction (0 to 3).
+  """
+  coords = as_coords(trees)
+  steps = [
+    (orchard_features[0]["slope"], orchard_features[0]["dist"]),
+    (orchard_features[0]["slope"], -orchard_features[0]["dist"]),
+    (orchard_features[1]["slope"], orchard_features[1]["dist"]),
+    (orchard_features[1]["slope"], -orchard_features[1]["dist"]),
+  ]
+  neighbours = np.stack([calculate_next_points(coords, slope, dist) for slope, dist in steps], axis=1)
+  return neighbours.reshape(-1, 2)
 
-    if len(temp) >= min_group_size:
-      groups.append(temp)
-    
-    # Remove these trees so we dont look at them again
-    for t in temp: 
-        trees.remove(t)
-  return groups
 
-def find_missing_trees(trees, orchard_features):
+def find_missing_tree_candidates(trees, orchard_features, index=None, precision=2.5):
+  """
+  Finds locations where there could be a tree in the orchard, but there isnt, along with the tree and
+  direction each location was expected from.
+
+  Parameters:
+  - trees: TreeSet (or an (N, 2) array) of the locations (north, east) of the trees in the orchard, in meters.
+  - orchard_features: A list of the major axes of the orchard, each containing a dictionary of the slope
+                      and average distance between trees on that axis. 
+  - index: Optional SpatialIndex built over trees, shared with the other stages.
+  - precision: How close an expected location should be to an actual tree to confirm that the tree exists.
+
+  Returns:
+  - missing_trees: (M, 2) array of the locations where there could be trees in the orchard (north, east)
+  - sources: (M,) array identifying where each location was expected from, as 4 * the index of the tree
+             plus the direction (0 to 3) it was expected in. The locations are in order of their sources.
+  """
+
+  if index is None:
+    index = SpatialIndex(trees, cell_size=precision)
+
+  neighbours = expected_tree_locations(trees, orchard_features)
+  tree_exists = index.any_within_many(neighbours, precision)
+  return neighbours[~tree_exists], np.flatnonzero(~tree_exists)
+
+
+def find_missing_trees(trees, orchard_features, index=None, precision=2.5):
   """
   Finds locations where there could be a tree in the orchard, but there isnt.
 
   Parameters:
-  - trees: List of tuples representing GPS coordinates of the trees in the orchard.
+  - trees: TreeSet (or an (N, 2) array) of the locations (north, east) of the trees in the orchard, in meters.
   - orchard_features: A list of the major axes of the orchard, each containing a dictionary of the slope
                       and average distance between trees on that axis. 
+  - index: Optional SpatialIndex built over trees, shared with the other stages.
+  - precision: How close an expected location should be to an actual tree to confirm that the tree exists.
+
+  Returns:
+  - missing_trees: TreeSet of the locations where there could be trees in the orchard (north, east), with
+                   the `source` of each (see find_missing_tree_candidates).
+  """
+  missing_trees, sources = find_missing_tree_candidates(trees, orchard_features, index, precision)
+  return TreeSet(missing_trees, {"source": sources})
+
+
+def detect_missing_trees(all_trees, min_group_size=3, precision=2.5, feature_tolerance=None):
+  """
+  Run the full missing tree detection pipeline on an orchard.
+
+  The trees are projected into a local frame and indexed once, every stage then runs in meters,
+  and only the centres of the missing tree groups are converted back to GPS coordinates.
+
+  Parameters:
+  - all_trees: TreeSet (or an (N, 2) array) of GPS coordinates (latitude, longitude) of all trees.
+  - min_group_size: How many expected locations should agree for a tree to count as missing.
+  - precision: How close trees should be to a location, or to each other, in meters.
+  - feature_tolerance: Optional distance in meters to sample the orchard features to (see
+                       get_orchard_features). By default every tree is used.
+
+  Returns:
+  - missing_tree_coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+  """
+  with stage("index"):
+    # Project the trees into a local frame once, so the whole pipeline can work in meters
+    projection = LocalProjection(all_trees)
+    tree_points = projection.to_local(all_trees)
+
+    # Index the trees once so that every stage can look up neighbours quickly. The cells match
+    # the precision used to check whether a tree exists at a location.
+    index = SpatialIndex(tree_points, cell_size=precision)
+
+  # Get slope and distance between trees on both axes in the orchard
+  with stage("features"):
+    features = get_orchard_features(tree_points, index, feature_tolerance)
+
+  # Find missing trees
+  with stage("candidates"):
+    missing_trees = find_missing_trees(tree_points, features, index, precision=precision)
+
+  # Group missing trees
+  with stage("groups"):
+    missing_tree_groups = find_tree_groups(missing_trees, min_group_size=min_group_size, precision=precision)
+
+  record_count("trees", len(tree_points))
+  record_count("candidates", len(missing_trees))
+  record_count("missing_trees", len(missing_tree_groups))
+
+  # Find average loc of missing trees, and convert them back to GPS coordinates
+  missing_tree_points = [missing_tree_group.center() for missing_tree_group in missing_tree_groups]
+  return projection.to_latlng(missing_tree_points)
+
+
+def find_linked(index, seeds, precision, alive=None):
+  """
+  Find every point linked to some seed points by a chain of points within `precision` of each other.
+
+  Parameters:
+  - index: SpatialIndex of the points.
+  - seeds: Array of the indices of the points to start from.
+  - precision: How close points should be to each other to be linked.
+  - alive: Optional boolean array of the points that can be linked. Other points are skipped, even
+           as seeds.
+
+  Returns:
+  - linked: Sorted array of the indices of the seeds and every point linked to them.
+  """
+  alive = np.ones(len(index), dtype=bool) if alive is None else alive
+  frontier = np.unique(np.asarray(seeds, dtype=np.int64))
+  frontier = frontier[alive[frontier]]
+  reached = np.zeros(len(alive), dtype=bool)
+  reached[frontier] = True
+  while len(frontier):
+    _, near, _ = index.within_many(index.coords[frontier], precision)
+    frontier = np.unique(near[alive[near] & ~reached[near]])
+    reached[frontier] = True
+  return np.flatnonzero(reached)
+
+
+def converge_missing_trees(tree_points, orchard_features, index, min_group_size=3, precision=2.5, max_iterations=10):
+  """
+  Find missing trees over several passes, adding the missing trees of each pass back into the
+  orchard, until a pass finds no new missing trees.
+
+  A single pass cannot find the inner trees of a run of missing trees, as they do not have enough
+  neighbours. Rather than rerunning the full pipeline on every pass, the expected locations are kept
+  between passes, and only the ones near the newly added trees are checked again: locations that the
+  new trees fill are dropped, the new trees add their own expected locations, and only the clusters
+  of locations that changed are grouped again. The result is the same as rerunning the pipeline.
+
+  Parameters:
+  - tree_points: (N, 2) array of the locations (north, east) of all trees, in meters.
+  - orchard_features: The major axes of the orchard, as returned by get_orchard_features. These are
+                      kept for every pass.
+  - index: SpatialIndex built over tree_points. The missing trees found are inserted into it.
+  - min_group_size: How many expected locations should agree for a tree to count as missing.
+  - precision: How close trees should be to a location, or to each other, in meters.
+  - max_iterations: The most passes to run.
+
+  Returns:
+  - missing_trees: (M, 2) array of the locations (north, east) of the missing trees found by every pass.
+  - iterations: The number of passes run, including the last one if it found nothing new.
+  """
+  candidates, sources = find_missing_tree_candidates(tree_points, orchard_features, index, precision)
+  candidate_index = SpatialIndex(candidates, cell_size=precision)
+  alive = np.ones(len(candidates), dtype=bool)
+
+  groups = find_tree_groups(TreeSet(candidates), min_group_size, precision)
+  new_trees = as_coords([group.center() for group in groups])
+  missing_trees = [new_trees]
+  iterations = 1
+
+  while len(new_trees) and iterations < max_iterations:
+    iterations += 1
+    new_indices = index.insert(new_trees)
+
+    # Expected locations that the new trees fill are no longer missing
+    _, filled, _ = candidate_index.within_many(new_trees, precision)
+    filled = filled[alive[filled]]
+    alive[filled] = False
+
+    # The new trees expect trees of their own around them
+    new_candidates, new_sources = find_missing_tree_candidates(new_trees, orchard_features, index, precision)
+    added = candidate_index.insert(new_candidates)
+    sources = np.concatenate([sources, 4 * new_indices[new_sources // 4] + new_sources % 4])
+    alive = np.concatenate([alive, np.ones(len(added), dtype=bool)])
+
+    # Only the clusters holding the added locations, or the neighbours of the filled ones, changed
+    _, touched, _ = candidate_index.within_many(candidate_index.coords[filled], precision)
+    changed = find_linked(candidate_index, np.concatenate([added, touched]), precision, alive)
+
+    # Group them in the order of their sources, as a full pass would
+    changed = changed[np.argsort(sources[changed], kind='stable')]
+    groups = find_tree_groups(TreeSet(candidate_index.coords[changed]), min_group_size, precision)
+    centres = as_coords([group.center() for group in groups])
+
+    # Groups where a tree has already been placed are not new
+    new_trees = centres[~index.any_within_many(centres, precision)]
+    missing_trees.append(new_trees)
+
+  return np.concatenate(missing_trees), iterations
+
+
+def detect_missing_trees_converged(all_trees, min_group_size=3, precision=2.5, feature_tolerance=None,
+                                   max_iterations=10):
+  """
+  Run the missing tree detection pipeline on an orchard until no new missing trees are found.
+
+  This is the same as detect_missing_trees, except that the missing trees are added back into the
+  orchard and searched again (see converge_missing_trees), so that runs of missing trees are found.
+
+  Parameters:
+  - all_trees: TreeSet (or an (N, 2) array) of GPS coordinates (latitude, longitude) of all trees.
+  - min_group_size: How many expected locations should agree for a tree to count as missing.
+  - precision: How close trees should be to a location, or to each other, in meters.
+  - feature_tolerance: Optional distance in meters to sample the orchard features to (see
+                       get_orchard_features). By default every tree is used.
+  - max_iterations: The most passes to run.
 
   Returns:
-  - missing_trees: A list of the locations where there could be trees in the orchard (lat, lng)
+  - missing_tree_coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+  - iterations: The number of passes run.
   """
+  with stage("index"):
+    projection = LocalProjection(all_trees)
+    tree_points = projection.to_local(all_trees)
+    index = SpatialIndex(tree_points, cell_size=precision)
 
-  missing_trees = []
-  for tree in trees: 
+  with stage("features"):
+    features = get_orchard_features(tree_points, index, feature_tolerance)
 
-    n1 = calculate_next_coordinate(tree, orchard_features[0]["slope"], orchard_features[0]["dist"])
-    n2 = calculate_next_coordinate(tree, orchard_features[0]["slope"], -orchard_features[0]["dist"])
-    n3 = calculate_next_coordinate(tree, orchard_features[1]["slope"], orchard_features[1]["dist"])
-    n4 = calculate_next_coordinate(tree, orchard_features[1]["slope"], -orchard_features[1]["dist"])
+  with stage("converge"):
+    missing_trees, iterations = converge_missing_trees(
+      tree_points, features, index, min_group_size, precision, max_iterations)
 
-    for neighbour in [n1,n2,n3,n4]:
-      tree_exists = is_tree_at_location(neighbour, trees, precision=2.5)
-      if (not tree_exists):
-        missing_trees.append(neighbour)
-  
-  return missing_trees
+  record_count("trees", len(tree_points))
+  record_count("missing_trees", len(missing_trees))
+  return projection.to_latlng(missing_trees), iterations
@@ -0,0 +1,88 @@
+import numpy as np
+from app.geodesy import EARTH_RADIUS, as_coords
+
+
+class LocalProjection:
+  """
+  A flat local frame (in meters) centred on a set of GPS coordinates.
+
+  Points in the frame are (north, east) offsets from the centre of the coordinates, so that
+  they line up with (latitude, longitude). Over the size of an orchard the frame is accurate
+  to well under a centimeter, so the detection pipeline can use plain Euclidean geometry and
+  only convert its final results back to GPS coordinates.
+  """
+
+  def __init__(self, coords):
+    """
+    Create the frame.
+
+    Parameters:
+    - coords: List of tuples (or an (N, 2) array) of GPS coordinates (latitude, longitude).
+    """
+    coords = as_coords(coords)
+    if len(coords):
+      self.origin = np.radians(coords.mean(axis=0))
+    else:
+      self.origin = np.zeros(2)
+    self.scale = np.array([EARTH_RADIUS, EARTH_RADIUS * np.cos(self.origin[0])])
+
+  def to_local(self, coords):
+    """
+    Project GPS coordinates into the frame.
+
+    Parameters:
+    - coords: List of tuples (or an (N, 2) array) of GPS coordinates (latitude, longitude).
+
+    Returns:
+    - points: (N, 2) array of (north, east) points in meters.
+    """
+    return (np.radians(as_coords(coords)) - self.origin) * self.scale
+
+  def to_latlng(self, points):
+    """
+    Convert points in the frame back to GPS coordinates.
+
+    Parameters:
+    - points: List of tuples (or an (N, 2) array) of (north, east) points in meters.
+
+    Returns:
+    - coords: (N, 2) array of GPS coordinates (latitude, longitude).
+    """
+    return np.degrees(as_coords(points) / self.scale + self.origin)
+
+
+def euclidean_distances(points1, points2):
+  """
+  Calculate the straight line distance between points in a local frame.
+
+  The inputs are broadcast against each other in the same way as geodesy.haversine_distances.
+
+  Parameters:
+  - points1: Array of (north, east) points in meters.
+  - points2: Array of (north, east) points in meters.
+
+  Returns:
+  - distances: Array of distances between the points in meters.
+  """
+  delta = np.asarray(points2, dtype=np.float64) - np.asarray(points1, dtype=np.float64)
+  return np.hypot(delta[..., 0], delta[..., 1])
+
+
+def calculate_next_points(start_points, gradient, distance_meters):
+  """
+  Calculate the next points in a local frame by moving along a line from starting points.
+
+  Parameters:
+  - start_points: (N, 2) array of starting (north, east) points in meters.
+  - gradient: Gradient (slope) of the line, as the change in east per meter north.
+  - distance_meters: Distance to move in meters, either a single value or one per point.
+
+  Returns:
+  - points: (N, 2) array of the next (north, east) points in meters.
+  """
+  if np.isinf(gradient):
+    direction = np.array([0.0, 1.0])
+  else:
+    direction = np.array([1.0, gradient]) / np.hypot(1.0, gradient)
+  distance_meters = np.asarray(distance_meters, dtype=np.float64)
+  return as_coords(start_points) + distance_meters[..., None] * direction
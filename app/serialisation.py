@@ -0,0 +1,192 @@
+import gzip
+import json
+import struct
+import numpy as np
+from fastapi.responses import Response
+
+JSON = "application/json"
+GEOJSON = "application/geo+json"
+# Parallel arrays of float64 latitudes and longitudes, see missing_trees_columnar
+COLUMNAR = "application/x-missing-trees-float64"
+MEDIA_TYPES = {"json": JSON, "geojson": GEOJSON, "columnar": COLUMNAR}
+
+# Magic bytes, length of the metadata, and number of missing trees, at the start of a columnar body
+COLUMNAR_MAGIC = b"MTF1"
+COLUMNAR_HEADER = struct.Struct("<4sIQ")
+
+# Bodies smaller than this are not worth compressing
+GZIP_MIN_SIZE = 500
+GZIP_LEVEL = 5
+
+
+def _points(coords, template):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    # Python floats format with %r exactly as json.dumps writes them
+    return ((template + ",") * len(coords))[:-1] % tuple(coords.ravel().tolist())
+
+
+def missing_trees_json(fields, coords):
+    """
+    Serialise missing trees as JSON, without building a dictionary for every tree.
+
+    Parameters:
+    - fields: Dictionary of the other fields of the response, such as the orchard_id.
+    - coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+
+    Returns:
+    - body: The fields and a `missing_trees` list of {"lat", "lng"} objects, as UTF-8 JSON.
+    """
+    head = json.dumps(fields, separators=(",", ":"))[:-1]
+    head += "," if fields else ""
+    return (head + '"missing_trees":[' + _points(coords, '{"lat":%r,"lng":%r}') + "]}").encode()
+
+
+def missing_trees_geojson(fields, coords):
+    """
+    Serialise missing trees as a GeoJSON Feature with a MultiPoint geometry.
+
+    Parameters:
+    - fields: Dictionary of the other fields of the response, which become the feature's properties.
+    - coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+
+    Returns:
+    - body: The feature as UTF-8 JSON. Its coordinates are (longitude, latitude), as GeoJSON requires.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)[:, ::-1]
+    properties = json.dumps(fields, separators=(",", ":"))
+    return (
+        '{"type":"Feature","geometry":{"type":"MultiPoint","coordinates":['
+        + _points(coords, "[%r,%r]") + ']},"properties":' + properties + "}").encode()
+
+
+def missing_trees_columnar(fields, coords):
+    """
+    Serialise missing trees as parallel arrays of float64 latitudes and longitudes.
+
+    The body is a 16 byte header of the magic bytes b"MTF1", the length of the metadata (uint32) and
+    the number of missing trees M (uint64), followed by the other fields as JSON (padded with spaces
+    to a multiple of 8 bytes), M latitudes, and M longitudes. Every number is little-endian, and the
+    arrays are aligned to 8 bytes, so they can be read without copying (see read_missing_trees_columnar).
+
+    Parameters:
+    - fields: Dictionary of the other fields of the response, such as the orchard_id.
+    - coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+
+    Returns:
+    - body: The serialised bytes.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    metadata = json.dumps(fields, separators=(",", ":")).encode()
+    metadata += b" " * (-len(metadata) % 8)
+    return b"".join([
+        COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, len(metadata), len(coords)),
+        metadata,
+        coords[:, 0].astype("<f8").tobytes(),
+        coords[:, 1].astype("<f8").tobytes(),
+    ])
+
+
+def read_missing_trees_columnar(body):
+    """
+    Read missing trees serialised by missing_trees_columnar.
+
+    Parameters:
+    - body: The serialised bytes.
+
+    Returns:
+    - fields: Dictionary of the other fields of the response.
+    - coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+    """
+    magic, metadata_length, count = COLUMNAR_HEADER.unpack_from(body)
+    if magic != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar missing trees body")
+    offset = COLUMNAR_HEADER.size + metadata_length
+    fields = json.loads(body[COLUMNAR_HEADER.size:offset])
+    lat = np.frombuffer(body, dtype="<f8", count=count, offset=offset)
+    lng = np.frombuffer(body, dtype="<f8", count=count, offset=offset + 8 * count)
+    return fields, np.column_stack([lat, lng])
+
+
+SERIALISERS = {JSON: missing_trees_json, GEOJSON: missing_trees_geojson, COLUMNAR: missing_trees_columnar}
+
+
+def _weighted(header):
+    # Split an Accept or Accept-Encoding header into (value, q) pairs
+    for part in header.split(","):
+        value, *parameters = [item.strip() for item in part.split(";")]
+        q = 1.0
+        for parameter in parameters:
+            name, _, number = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        if value:
+            yield value.lower(), q
+
+
+def _quality(weights, *values):
+    # The q of the first of the values (most specific first) that the header lists, or 0 if none are
+    for value in values:
+        if value in weights:
+            return weights[value]
+    return 0.0
+
+
+def negotiate_media_type(accept):
+    """
+    Choose the format of a missing trees response from the Accept header of the request.
+
+    A media type listed on its own takes precedence over `application/*`, which takes precedence
+    over `*/*`, so that `application/json;q=0, */*` refuses JSON. A q of 0 is a refusal.
+
+    Parameters:
+    - accept: The Accept header, or None.
+
+    Returns:
+    - media_type: The supported media type the client prefers most, in the order it listed them. JSON
+                  if the client only accepts wildcards, or None if it accepts none of the supported types.
+    """
+    if not accept:
+        return JSON
+    weights = {}
+    for media_type, q in _weighted(accept):
+        weights.setdefault(media_type, q)
+    candidates = [media_type for media_type in weights if media_type in SERIALISERS] + [JSON]
+    qualities = [_quality(weights, media_type, "application/*", "*/*") for media_type in candidates]
+    best = max(range(len(candidates)), key=qualities.__getitem__)
+    return candidates[best] if qualities[best] > 0 else None
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Check whether a client accepts gzipped responses, from the Accept-Encoding header of its request.
+    gzip listed on its own takes precedence over `*`, and a q of 0 is a refusal.
+    """
+    weights = {}
+    for encoding, q in _weighted(accept_encoding or ""):
+        weights.setdefault(encoding, q)
+    return _quality(weights, "gzip", "*") > 0
+
+
+def missing_trees_response(fields, coords, media_type=JSON, accept_encoding=None, headers=None):
+    """
+    Serialise missing trees into a response, gzipped if the client accepts it.
+
+    Parameters:
+    - fields: Dictionary of the other fields of the response, such as the orchard_id.
+    - coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+    - media_type: One of the supported media types.
+    - accept_encoding: The Accept-Encoding header of the request, or None.
+    - headers: Optional dictionary of other headers to send.
+
+    Returns:
+    - response: The response to send.
+    """
+    body = SERIALISERS[media_type](fields, coords)
+    headers = {**(headers or {}), "Vary": "Accept, Accept-Encoding"}
+    if len(body) >= GZIP_MIN_SIZE and accepts_gzip(accept_encoding):
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type=media_type, headers=headers)
@@ -0,0 +1,66 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into a single call.
+
+    The first caller for a key starts the work, and any callers that arrive for the same key while
+    it is still running wait for and share its result (or its exception) instead of starting their
+    own. Once the work finishes, the next caller for the key starts it again.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.waiters = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(self, key, func, *args, **kwargs):
+        """
+        Run a coroutine function for a key, or wait for the call already running for that key.
+
+        Parameters:
+        - key: A hashable key identifying the work, such as the orchard and detection parameters.
+        - func: Coroutine function doing the work.
+        - args, kwargs: Arguments passed to func if the work is started.
+
+        Returns:
+        - The result of the call.
+        """
+        task = self.calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self.calls[key] = task
+            self.waiters[key] = 0
+            task.add_done_callback(lambda _: self._finish(key, task))
+        else:
+            self.coalesced += 1
+            self.waiters[key] += 1
+
+        # Shield the shared call, so that one caller going away does not cancel it for the others
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        # Mark any exception as retrieved, in case every caller went away before it was raised
+        if not task.cancelled():
+            task.exception()
+        if self.calls.get(key) is task:
+            del self.calls[key]
+            del self.waiters[key]
+
+    def stats(self):
+        """
+        Get the counters of the coalesced calls.
+
+        Returns:
+        - stats: A dictionary of the number of calls in flight, the callers currently waiting on
+                 them, and the total number of calls started and of callers coalesced onto them.
+        """
+        return {
+            "in_flight": len(self.calls),
+            "waiting": sum(self.waiters.values()),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,302 @@
+import numpy as np
+from app.geodesy import as_coords
+from app.projection import euclidean_distances
+from app.tree_set import TreeSet
+
+# Query points are answered this many at a time, so the cells and candidates of every point are
+# never expanded at once
+QUERY_CHUNK_SIZE = 4096
+
+
+class SpatialIndex:
+  """
+  A uniform grid hash over a set of trees, used to answer neighbour queries without
+  scanning every tree in the orchard.
+
+  The trees are points in a local frame (in meters, see projection.LocalProjection), and are
+  bucketed into square cells. Queries only visit the cells around the query points, and
+  candidates are then ranked by distance so that the answers are identical to a full scan.
+  Every query has a batch form that answers many points in one pass.
+
+  The index should be built once per request and shared by every stage that needs it.
+  """
+
+  def __init__(self, trees, cell_size=2.5):
+    """
+    Build the index.
+
+    Parameters:
+    - trees: TreeSet (or a list of tuples, or an (N, 2) array) of (north, east) points of all trees, in meters.
+    - cell_size: The width of a grid cell in meters (default is 2.5).
+    """
+    self.trees = trees if isinstance(trees, (np.ndarray, TreeSet)) else list(trees)
+    self.coords = as_coords(self.trees)
+    self.cell_size = cell_size
+    self._knn_index = None
+    self._build()
+
+  def __len__(self):
+    return len(self.coords)
+
+  def _build(self):
+    rows, cols = self._cells(self.coords)
+    if len(self.coords):
+      self.bounds = (rows.min(), rows.max(), cols.min(), cols.max())
+    else:
+      self.bounds = (0, -1, 0, -1)
+
+    # Sort the trees by cell so that each cell is a contiguous run of `order`
+    keys, _ = self._keys(rows, cols)
+    self.order = np.argsort(keys, kind='stable')
+    self.sorted_keys = keys[self.order]
+
+  def insert(self, trees):
+    """
+    Add trees to the index, numbering them after the trees already in it.
+
+    The new trees are merged into the sorted cells, so the index is not rebuilt unless they fall
+    outside its bounds.
+
+    Parameters:
+    - trees: List of tuples (or an (N, 2) array) of (north, east) points of the new trees, in meters.
+
+    Returns:
+    - indices: Array of the indices of the new trees.
+    """
+    points = as_coords(trees)
+    indices = np.arange(len(self.coords), len(self.coords) + len(points))
+    if isinstance(self.trees, TreeSet):
+      self.trees = TreeSet.concatenate([self.trees, TreeSet(points)])
+    elif isinstance(self.trees, np.ndarray):
+      self.trees = np.concatenate([self.trees, points])
+    else:
+      self.trees.extend(tuple(point) for point in points.tolist())
+    self.coords = np.concatenate([self.coords, points])
+
+    rows, cols = self._cells(points)
+    keys, valid = self._keys(rows, cols)
+    if not valid.all():
+      self._build()
+      return indices
+
+    # New trees go after the trees already in their cell, so each cell stays in index order
+    ordering = np.argsort(keys, kind='stable')
+    positions = np.searchsorted(self.sorted_keys, keys[ordering], side='right')
+    self.sorted_keys = np.insert(self.sorted_keys, positions, keys[ordering])
+    self.order = np.insert(self.order, positions, indices[ordering])
+    return indices
+
+  def _cells(self, points):
+    return (np.floor(points[:, 0] / self.cell_size).astype(np.int64),
+            np.floor(points[:, 1] / self.cell_size).astype(np.int64))
+
+  def _keys(self, rows, cols):
+    """
+    Flatten cell rows and columns into keys. Cells outside the bounds of the index are
+    marked as invalid, since they cannot contain any trees.
+    """
+    min_row, max_row, min_col, max_col = self.bounds
+    valid = (rows >= min_row) & (rows <= max_row) & (cols >= min_col) & (cols <= max_col)
+    keys = (rows - min_row) * (max_col - min_col + 1) + (cols - min_col)
+    return np.where(valid, keys, -1), valid
+
+  def _candidates(self, points, rings):
+    """
+    Find every tree in the cells within `rings` cells of each query point. When that would
+    visit more cells than there are trees, every tree is returned as a candidate instead.
+
+    Returns:
+    - query_indices, tree_indices: Matching arrays of candidate (query point, tree) pairs.
+    - exhaustive: True if every tree was returned for every query point.
+    """
+    if (2 * rings + 1) ** 2 > len(self):
+      # Only reached for small indexes, where every pair is cheap
+      query_indices = np.repeat(np.arange(len(points)), len(self))
+      return query_indices, np.tile(np.arange(len(self)), len(points)), True
+
+    rows, cols = self._cells(points)
+    offsets = np.arange(-rings, rings + 1)
+    d_rows, d_cols = np.meshgrid(offsets, offsets, indexing='ij')
+
+    keys, valid = self._keys(rows[:, None] + d_rows.ravel(), cols[:, None] + d_cols.ravel())
+    starts = np.searchsorted(self.sorted_keys, keys, side='left')
+    counts = np.where(valid, np.searchsorted(self.sorted_keys, keys, side='right') - starts, 0)
+
+    query_indices = np.repeat(np.arange(len(points)), counts.sum(axis=1))
+    counts = counts.ravel()
+    run_starts = np.repeat(starts.ravel(), counts)
+    run_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return query_indices, self.order[run_starts + run_offsets], False
+
+  def _rings_for_radius(self, radius):
+    return int(np.ceil(radius / self.cell_size))
+
+  def within_many(self, points, radius):
+    """
+    Find all trees within a radius of each of a set of locations.
+
+    Parameters:
+    - points: (N, 2) array of (north, east) target locations.
+    - radius: The search radius in meters.
+
+    Returns:
+    - query_indices, tree_indices, distances: Matching arrays of every (location, tree) pair
+                                              within the radius, ordered by location then tree.
+    """
+    points = as_coords(points)
+    rings = self._rings_for_radius(radius)
+    chunks = []
+    for start in range(0, len(points), QUERY_CHUNK_SIZE):
+      chunk = points[start:start + QUERY_CHUNK_SIZE]
+      query_indices, tree_indices, _ = self._candidates(chunk, rings)
+      distances = euclidean_distances(chunk[query_indices], self.coords[tree_indices])
+
+      close = distances <= radius
+      query_indices, tree_indices, distances = query_indices[close], tree_indices[close], distances[close]
+      ordering = np.lexsort((tree_indices, query_indices))
+      chunks.append((query_indices[ordering] + start, tree_indices[ordering], distances[ordering]))
+
+    if not chunks:
+      return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    return tuple(np.concatenate(arrays) for arrays in zip(*chunks))
+
+  def any_within_many(self, points, radius):
+    """
+    Check if there is any tree within a radius of each of a set of locations.
+
+    Parameters:
+    - points: (N, 2) array of (north, east) target locations.
+    - radius: The search radius in meters.
+
+    Returns:
+    - found: (N,) boolean array, True where a tree lies within the radius.
+    """
+    points = as_coords(points)
+    query_indices, _, _ = self.within_many(points, radius)
+    found = np.zeros(len(points), dtype=bool)
+    found[query_indices] = True
+    return found
+
+  def nearest_many(self, points, k=4):
+    """
+    Find the k closest trees to each of a set of target trees.
+
+    Trees at exactly the same location as a target (including the target itself) are
+    ignored. Ties are broken by the order of the trees in the index.
+
+    Parameters:
+    - points: (N, 2) array of (north, east) target trees.
+    - k: Number of closest trees to find (default is 4).
+
+    The grid of the index is sized for the precision of the pipeline, which is much finer than the
+    spacing of the trees, so the search runs on a coarser grid sized from the density of the trees
+    instead (see knn_index), a chunk of target trees at a time.
+
+    Returns:
+    - closest: (N, k) array of the indices of the closest trees, closest first. Rows are padded
+               with -1 when the index holds fewer than k other trees.
+    """
+    points = as_coords(points)
+    index = self.knn_index(k)
+    closest = np.full((len(points), k), -1, dtype=np.int64)
+    for start in range(0, len(points), QUERY_CHUNK_SIZE):
+      closest[start:start + QUERY_CHUNK_SIZE] = index._nearest_chunk(points[start:start + QUERY_CHUNK_SIZE], k)
+    return closest
+
+  def knn_index(self, k=4):
+    """
+    Get an index of the same trees with cells sized so that the k nearest trees are usually within
+    one cell, for nearest neighbour searches. It is built the first time it is needed, and again after trees are inserted.
+
+    Returns:
+    - index: A SpatialIndex with the same tree indices, or this index if its cells are not much
+             smaller than that already.
+    """
+    if not len(self):
+      return self
+    min_row, max_row, min_col, max_col = self.bounds
+    area = (max_row - min_row + 1) * (max_col - min_col + 1) * self.cell_size ** 2
+    # A circle one cell wide holds about k trees, so most searches end after the first ring of cells
+    cell_size = float(np.sqrt(k * area / (np.pi * len(self))))
+    if cell_size < 2 * self.cell_size:
+      return self
+    if self._knn_index is None or len(self._knn_index) != len(self):
+      self._knn_index = SpatialIndex(self.coords, cell_size=cell_size)
+    return self._knn_index
+
+  def _nearest_chunk(self, points, k):
+    closest = np.full((len(points), k), -1, dtype=np.int64)
+    pending = np.arange(len(points))
+    radius = self.cell_size
+
+    while len(pending):
+      query_indices, tree_indices, exhaustive = self._candidates(points[pending], self._rings_for_radius(radius))
+      distances = euclidean_distances(points[pending][query_indices], self.coords[tree_indices])
+
+      # Every tree within the radius of a target has been seen, so if at least k of them are
+      # inside it they are the k closest
+      keep = (distances > 0) & ((distances <= radius) | exhaustive)
+      query_indices, tree_indices, distances = query_indices[keep], tree_indices[keep], distances[keep]
+      ordering = np.lexsort((tree_indices, distances, query_indices))
+      query_indices, tree_indices = query_indices[ordering], tree_indices[ordering]
+
+      counts = np.bincount(query_indices, minlength=len(pending))
+      ranks = np.arange(len(query_indices)) - np.repeat(np.cumsum(counts) - counts, counts)
+      done = (counts >= k) | exhaustive
+
+      take = done[query_indices] & (ranks < k)
+      closest[pending[query_indices[take]], ranks[take]] = tree_indices[take]
+
+      pending = pending[~done]
+      radius *= 2
+
+    return closest
+
+  def nearest(self, tree, k=4):
+    """
+    Find the k closest trees to a target tree.
+
+    Parameters:
+    - tree: Tuple (north, east) for the target tree.
+    - k: Number of closest trees to find (default is 4).
+
+    Returns:
+    - closest: List of the indices of the closest trees, closest first.
+    """
+    return [int(i) for i in self.nearest_many([tree], k)[0] if i >= 0]
+
+  def nearest_trees(self, tree, k=4):
+    """
+    Find the k closest trees to a target tree.
+
+    Returns:
+    - closest: List of the closest tree coordinates to the target tree.
+    """
+    return [self.trees[i] for i in self.nearest(tree, k)]
+
+  def within(self, tree, radius):
+    """
+    Find all trees within a radius of a target location.
+
+    Parameters:
+    - tree: Tuple (north, east) for the target location.
+    - radius: The search radius in meters.
+
+    Returns:
+    - indices: List of the indices of the trees within the radius, in index order.
+    """
+    _, tree_indices, _ = self.within_many([tree], radius)
+    return tree_indices.tolist()
+
+  def any_within(self, tree, radius):
+    """
+    Check if there is any tree within a radius of a target location.
+
+    Parameters:
+    - tree: Tuple (north, east) for the target location.
+    - radius: The search radius in meters.
+
+    Returns:
+    - boolean: True if a tree lies within the radius, False otherwise.
+    """
+    return bool(self.any_within_many([tree], radius)[0])
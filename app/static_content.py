@@ -0,0 +1,118 @@
+import gzip
+import hashlib
+import os
+import threading
+import markdown
+from fastapi.responses import HTMLResponse, Response
+from fastapi.staticfiles import StaticFiles
+from app.serialisation import GZIP_MIN_SIZE, accepts_gzip
+
+
+class LandingPage:
+    """
+    The README, rendered to an HTML page.
+
+    The page is rendered the first time it is needed and kept, along with a gzipped copy and an
+    ETag, so serving it is only a matter of sending the bytes. It is rendered again if the README
+    is changed on disk, which is checked from the file's modification time and size on every hit.
+    """
+
+    def __init__(self, path, host_name=None):
+        """
+        Create the page.
+
+        Parameters:
+        - path: The path of the markdown file to render.
+        - host_name: The host name of the server, used in links to images.
+        """
+        self.path = path
+        self.host_name = host_name
+        self.lock = threading.Lock()
+        self.version = None
+        self.page = None
+        self.renders = 0
+
+    def render(self, readme_md):
+        # Convert the input to HTML
+        readme = markdown.markdown(readme_md)
+
+        html_content = f"""
+    <html>
+        <head>
+            <title>Aerobotics Assignment</title>
+        </head>
+        <body>
+            {readme}
+        </body>
+    </html>
+    """
+
+        img_str = f"![img](http://{self.host_name}:8000/"
+        return html_content.replace("![img](", img_str)
+
+    def get(self):
+        """
+        Get the rendered page, rendering it again first if the README has changed.
+
+        Returns:
+        - page: A dictionary of the `html` and `gzip` bodies as bytes, and their `etag`.
+        """
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    with open(self.path, 'r') as file:
+                        html = self.render(file.read()).encode()
+                    digest = hashlib.sha256(html).hexdigest()[:32]
+                    self.page = {"html": html, "gzip": gzip.compress(html, mtime=0), "etag": f'"{digest}"'}
+                    self.version = version
+                    self.renders += 1
+        return self.page
+
+    def response(self, request_headers):
+        """
+        Serve the page, gzipped if the client accepts it, or as 304 Not Modified if the client
+        already has it.
+
+        Parameters:
+        - request_headers: The headers of the request.
+
+        Returns:
+        - response: The response to send.
+        """
+        page = self.get()
+        # The ETag is weak, as the gzipped and plain bodies are the same page
+        headers = {"ETag": f'W/{page["etag"]}', "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if_none_match = request_headers.get("if-none-match", "")
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if page["etag"] in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+
+        if len(page["html"]) >= GZIP_MIN_SIZE and accepts_gzip(request_headers.get("accept-encoding")):
+            headers["Content-Encoding"] = "gzip"
+            return HTMLResponse(content=page["gzip"], headers=headers)
+        return HTMLResponse(content=page["html"], headers=headers)
+
+
+class CachedStaticFiles(StaticFiles):
+    """
+    Static files served with a Cache-Control header, so that clients and proxies can keep them for
+    a while instead of checking them on every page load.
+    """
+
+    def __init__(self, *args, max_age=86400, **kwargs):
+        """
+        Create the static files app.
+
+        Parameters:
+        - max_age: Seconds that clients can keep each file without checking it again.
+        - args, kwargs: Arguments passed on to StaticFiles.
+        """
+        super().__init__(*args, **kwargs)
+        self.cache_control = f"public, max-age={max_age}"
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = self.cache_control
+        return response
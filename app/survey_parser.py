@@ -0,0 +1,125 @@
+import ijson
+import numpy as np
+from app.tree_set import TreeSet
+
+# Arrays are allocated with this many rows when a page does not say how many results it has
+INITIAL_CAPACITY = 1024
+
+
+class SurveyParser:
+    """
+    An incremental parser for a page of tree survey results from the Aerobotics API.
+
+    Chunks of the response body are fed in as they arrive. Only the latitude and longitude of each
+    tree (and any other chosen numeric fields) are kept, and they are written straight into
+    preallocated float64 arrays, so the full list of result dictionaries is never built.
+    """
+
+    def __init__(self, fields=(), page_size=None):
+        """
+        Create the parser.
+
+        Parameters:
+        - fields: Optional names of other numeric fields of each tree to keep, such as 'id' or 'height'.
+        - page_size: Optional number of results the page is expected to hold, used with the `count` of
+                     the survey to size the arrays up front. Without it, the arrays grow as needed.
+        """
+        self.fields = tuple(fields)
+        self.page_size = page_size
+        self.count = None
+        self.next = None
+        self.survey_id = None
+        self.size = 0
+        self._allocate(INITIAL_CAPACITY)
+
+        self._events = ijson.sendable_list()
+        self._parser = ijson.parse_coro(self._events, use_float=True)
+
+    def _allocate(self, capacity):
+        self.coords = np.full((capacity, 2), np.nan)
+        self.values = {field: np.full(capacity, np.nan) for field in self.fields}
+
+    def _grow(self, capacity):
+        coords, values = self.coords, self.values
+        self._allocate(capacity)
+        self.coords[:len(coords)] = coords
+        for field, field_values in values.items():
+            self.values[field][:len(field_values)] = field_values
+
+    def feed(self, chunk):
+        """
+        Parse the next chunk of the response body.
+
+        Parameters:
+        - chunk: Bytes of the response body.
+        """
+        self._parser.send(chunk)
+        for prefix, event, value in self._events:
+            if prefix == 'results.item':
+                if event == 'end_map':
+                    self.size += 1
+                elif event == 'start_map' and self.size == len(self.coords):
+                    self._grow(2 * len(self.coords))
+            elif prefix.startswith('results.item.'):
+                name = prefix[len('results.item.'):]
+                if name == 'latitude':
+                    self.coords[self.size, 0] = value
+                elif name == 'longitude':
+                    self.coords[self.size, 1] = value
+                elif name == 'survey_id' and self.survey_id is None:
+                    self.survey_id = value
+                if name in self.values and value is not None:
+                    self.values[name][self.size] = value
+            elif prefix == 'count' and event == 'number':
+                # The count comes before the results. It is the size of the whole survey rather than
+                # of this page, so the arrays are only sized from it when the page size is known.
+                self.count = value
+                if self.page_size is not None and min(value, self.page_size) > len(self.coords):
+                    self._grow(min(value, self.page_size))
+            elif prefix == 'next':
+                self.next = value
+        del self._events[:]
+
+    def close(self):
+        """
+        Finish parsing the response.
+
+        Returns:
+        - page: A dictionary containing the total `count` of results, the `next` page link, the
+                number of `results` on the page, the `survey_id` of the first tree, and the `trees`
+                as a TreeSet of their GPS coordinates (latitude, longitude) with any chosen fields as
+                attributes. Trees without both a latitude and a longitude are left out of `trees`,
+                but are still counted in `results`.
+        """
+        self._parser.close()
+        # Selecting the rows copies them, so the page does not keep the spare capacity of the arrays alive
+        located = ~np.isnan(self.coords[:self.size]).any(axis=1)
+        return {
+            "count": self.count,
+            "next": self.next,
+            "results": self.size,
+            "survey_id": self.survey_id,
+            "trees": TreeSet(
+                self.coords[:self.size][located],
+                {field: values[:self.size][located] for field, values in self.values.items()}),
+        }
+
+
+def concatenate_pages(pages):
+    """
+    Combine parsed pages of survey results into one, keeping the pages in order.
+
+    Parameters:
+    - pages: A list of pages, as returned by SurveyParser.close.
+
+    Returns:
+    - survey: A single page containing the results of every page.
+    """
+    first = pages[0]
+    return {
+        "count": first["count"],
+        "next": None,
+        "results": sum(page["results"] for page in pages),
+        "survey_id": first["survey_id"],
+        "trees": TreeSet.concatenate(page["trees"] for page in pages),
+    }
@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import threading
+import time
+import numpy as np
+from app.survey_parser import SurveyParser
+from app.tree_set import TREE_ATTRIBUTES, TreeSet
+
+INDEX_FILE = "index.json"
+
+
+class SurveyStore:
+    """
+    A local store of fetched tree surveys, kept on disk so that they survive restarts.
+
+    The coordinates and other fields of each survey are saved as .npy files, and are loaded back
+    as read-only memory maps, so a stored survey is not read into memory or copied until it is used.
+    A small JSON index records the survey_id and fetch time of the latest survey of each orchard.
+    Only the latest survey of an orchard is kept.
+    """
+
+    def __init__(self, directory, ttl=None, clock=time.time):
+        """
+        Open the store, creating its directory if needed.
+
+        Parameters:
+        - directory: The directory the surveys are saved in.
+        - ttl: Optional number of seconds a stored survey stays fresh for after it was fetched. If
+               None, stored surveys never go stale, which is useful for replaying recorded surveys.
+        - clock: Function returning the current time in seconds since the epoch.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, INDEX_FILE)) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {}
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, orchard_id):
+        """
+        Load the latest stored survey of an orchard, if it is still fresh.
+
+        Parameters:
+        - orchard_id: The id of the orchard.
+
+        Returns:
+        - survey: The survey, in the same form as AeroboticsClient.get_survey, with its trees backed by
+                  memory maps of the stored files. None if there is no fresh survey for the orchard.
+        """
+        entry = self.index.get(str(orchard_id))
+        if entry is None:
+            self.misses += 1
+            return None
+        if self.ttl is not None and self.clock() - entry["fetched_at"] > self.ttl:
+            self.stale += 1
+            return None
+
+        try:
+            coords = np.load(self._path(entry["files"]["coords"]), mmap_mode="r")
+            attributes = {
+                name: np.load(self._path(file), mmap_mode="r")
+                for name, file in entry["files"].items() if name != "coords"}
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return {
+            "count": entry["count"],
+            "next": None,
+            "survey_id": entry["survey_id"],
+            "trees": TreeSet(coords, attributes),
+        }
+
+    def put(self, orchard_id, survey, fetched_at=None):
+        """
+        Save a survey as the latest survey of an orchard, replacing any older one.
+
+        Parameters:
+        - orchard_id: The id of the orchard.
+        - survey: The survey, as returned by AeroboticsClient.get_survey.
+        - fetched_at: Optional time the survey was fetched. Defaults to now.
+        """
+        trees = survey["trees"]
+        prefix = f"{orchard_id}-{survey['survey_id']}"
+        arrays = {"coords": trees.coords, **trees.attributes}
+        files = {name: f"{prefix}.{name}.npy" for name in arrays}
+
+        with self.lock:
+            for name, values in arrays.items():
+                # Write to a temporary file first, so a reader never maps a half written file
+                temporary = self._path(files[name] + ".tmp")
+                with open(temporary, "wb") as f:
+                    np.save(f, np.ascontiguousarray(values))
+                os.replace(temporary, self._path(files[name]))
+
+            previous = self.index.get(str(orchard_id))
+            self.index[str(orchard_id)] = {
+                "orchard_id": orchard_id,
+                "survey_id": survey["survey_id"],
+                "count": len(trees),
+                "fetched_at": self.clock() if fetched_at is None else fetched_at,
+                "files": files,
+            }
+            self._write_index()
+
+            if previous is not None:
+                for file in set(previous["files"].values()) - set(files.values()):
+                    try:
+                        os.remove(self._path(file))
+                    except FileNotFoundError:
+                        pass
+
+    def _write_index(self):
+        temporary = self._path(INDEX_FILE + ".tmp")
+        with open(temporary, "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(temporary, self._path(INDEX_FILE))
+
+    def stats(self):
+        """
+        Get the counters of the store.
+
+        Returns:
+        - stats: A dictionary of the number of orchards stored, and of the fresh, stale and missing lookups.
+        """
+        return {
+            "size": len(self.index),
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+        }
+
+
+def load_recorded_survey(path, fields=TREE_ATTRIBUTES):
+    """
+    Parse a recorded response of the Aerobotics tree survey endpoint, such as
+    visualise/response_1701867391762.json.
+
+    Parameters:
+    - path: The path of the recorded JSON response.
+    - fields: Names of other numeric fields of each tree to keep.
+
+    Returns:
+    - survey: The survey, in the same form as AeroboticsClient.get_survey.
+    """
+    parser = SurveyParser(fields)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            parser.feed(chunk)
+    return parser.close()
+
+
+def main():
+    """
+    Import recorded surveys into a store, or replay them through the pipeline, with no network.
+
+    > python -m app.survey_store import surveys/ 216269 visualise/response_1701867391762.json
+    > python -m app.survey_store replay visualise/response_1701867391762.json
+    """
+    from app.orchard_utils import detect_missing_trees
+
+    parser = argparse.ArgumentParser(description=main.__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    store_import = commands.add_parser("import", help="Save a recorded survey as the latest survey of an orchard")
+    store_import.add_argument("directory")
+    store_import.add_argument("orchard_id", type=int)
+    store_import.add_argument("path")
+    replay = commands.add_parser("replay", help="Print the missing trees of a recorded survey")
+    replay.add_argument("path")
+    args = parser.parse_args()
+
+    survey = load_recorded_survey(args.path)
+    if args.command == "import":
+        SurveyStore(args.directory).put(args.orchard_id, survey)
+        print(f"Stored survey {survey['survey_id']} of orchard {args.orchard_id} ({survey['count']} trees)")
+    else:
+        missing_tree_coords = detect_missing_trees(survey["trees"])
+        print(json.dumps([{"lat": lat, "lng": lng} for lat, lng in missing_tree_coords.tolist()]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import numpy as np
+from app.geodesy import as_coords
+from app.metrics import record_count, stage
+from app.orchard_utils import get_orchard_features, find_missing_tree_candidates, union_find_clusters
+from app.projection import LocalProjection
+from app.spatial_index import SpatialIndex
+from app.tree_set import TreeSet
+
+
+def tile_halo(orchard_features, precision):
+  """
+  Get how far past its edges a tile needs the trees of its neighbours.
+
+  A missing tree found in a tile is expected from a tree up to one tree spacing away, is checked
+  against trees up to `precision` away, and is grouped with missing trees up to `precision` away,
+  which are checked against trees up to `precision` further still.
+
+  Parameters:
+  - orchard_features: The major axes of the orchard, as returned by get_orchard_features.
+  - precision: How close trees should be to a location, or to each other, in meters.
+
+  Returns:
+  - halo: The width of the halo around each tile, in meters.
+  """
+  spacing = max(abs(feature["dist"]) for feature in orchard_features)
+  return spacing + 2 * precision
+
+
+def plan_tiles(points, tile_size, halo):
+  """
+  Split an orchard into square tiles, each with the trees inside it and inside its halo.
+
+  Parameters:
+  - points: (N, 2) array of (north, east) points of all trees, in meters.
+  - tile_size: The width of a tile in meters.
+  - halo: How far past its edges each tile takes trees from, in meters.
+
+  Returns:
+  - origin: The (north, east) corner the tiles are laid out from.
+  - tiles: A list of (tile, tree_indices) tuples, where tile is the (row, column) of the tile and
+           tree_indices is an array of the trees it holds, in order.
+  """
+  points = as_coords(points)
+  origin = points.min(axis=0)
+  first = np.floor((points - origin - halo) / tile_size).astype(np.int64)
+  last = np.floor((points - origin + halo) / tile_size).astype(np.int64)
+
+  # Every tree goes into each tile whose halo it falls in, which is a small block of tiles around it
+  span = int((last - first).max()) + 1 if len(points) else 0
+  rows, columns, trees = [], [], []
+  for row_offset in range(span):
+    for column_offset in range(span):
+      tile = first + (row_offset, column_offset)
+      inside = np.all(tile <= last, axis=1)
+      rows.append(tile[inside, 0])
+      columns.append(tile[inside, 1])
+      trees.append(np.flatnonzero(inside))
+
+  rows, columns, trees = np.concatenate(rows), np.concatenate(columns), np.concatenate(trees)
+  ordering = np.lexsort((trees, columns, rows))
+  rows, columns, trees = rows[ordering], columns[ordering], trees[ordering]
+  starts = np.flatnonzero(np.r_[True, (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])])
+  ends = np.r_[starts[1:], len(trees)]
+  tiles = [((int(rows[s]), int(columns[s])), trees[s:e]) for s, e in zip(starts, ends)]
+  return origin, tiles
+
+
+def detect_tile(job):
+  """
+  Find the missing trees in one tile, and how they link up with the missing trees around them.
+
+  This runs in a worker process, so it only takes and returns plain values and arrays.
+
+  Parameters:
+  - job: A dictionary of the `tile` (row, column), the tile layout (`origin`, `tile_size`), the
+         `points` and global `tree_indices` of the trees in the tile and its halo, the orchard
+         `features`, and the `precision`.
+
+  Returns:
+  - sources: (M,) array of the global sources (see find_missing_tree_candidates) of the missing
+             trees inside the tile, in order.
+  - missing_trees: (M, 2) array of the locations of those missing trees.
+  - links: (L, 2) array of pairs of sources of missing trees within `precision` of each other,
+           where at least one of the pair is inside the tile.
+  """
+  precision = job["precision"]
+  tile_min = job["origin"] + np.asarray(job["tile"]) * job["tile_size"]
+  tile_max = tile_min + job["tile_size"]
+
+  candidates, local_sources = find_missing_tree_candidates(
+    job["points"], job["features"], precision=precision)
+  sources = 4 * job["tree_indices"][local_sources // 4] + local_sources % 4
+
+  # Missing trees near the tile are kept so they can be linked to the ones inside it. A missing
+  # tree belongs to the tile it falls in, using the same layout as plan_tiles, so each one is
+  # reported by exactly one tile.
+  near = np.all((candidates >= tile_min - precision) & (candidates <= tile_max + precision), axis=1)
+  candidates, sources = candidates[near], sources[near]
+  tiles = np.floor((candidates - job["origin"]) / job["tile_size"]).astype(np.int64)
+  inside = np.all(tiles == job["tile"], axis=1)
+
+  index = SpatialIndex(candidates, cell_size=precision)
+  close, other, _ = index.within_many(candidates[inside], precision)
+  links = np.stack([sources[inside][close], sources[other]], axis=1)
+  return sources[inside], candidates[inside], links
+
+
+def merge_tiles(results, min_group_size):
+  """
+  Combine the missing trees of every tile, and group them across the tile edges.
+
+  The missing trees are put back in the order of their sources, and clustered with the same
+  union-find as find_tree_clusters (union_find_clusters), so the groups come out exactly as they would for the whole
+  orchard at once.
+
+  Parameters:
+  - results: The outputs of detect_tile for every tile.
+  - min_group_size: How many missing trees should be located together to count as a group.
+
+  Returns:
+  - groups: A list of the TreeSets of missing trees in each group, with their `source`.
+  """
+  results = list(results)
+  if not results:
+    return []
+  sources = np.concatenate([result[0] for result in results])
+  missing_trees = np.concatenate([result[1] for result in results])
+  links = np.concatenate([result[2] for result in results])
+
+  ordering = np.argsort(sources, kind="stable")
+  missing_trees = TreeSet(missing_trees[ordering], {"source": sources[ordering]})
+  links = np.searchsorted(missing_trees.attributes["source"], links)
+
+  clusters = union_find_clusters(len(missing_trees), links)
+  return [missing_trees[members] for members in clusters if len(members) >= min_group_size]
+
+
+def plan_tiled_detection(all_trees, precision=2.5, feature_tolerance=None, tile_size=250.0):
+  """
+  Prepare an orchard to have its missing trees found in tiles, by detect_tile.
+
+  Parameters:
+  - all_trees: TreeSet (or an (N, 2) array) of GPS coordinates (latitude, longitude) of all trees.
+  - precision: How close trees should be to a location, or to each other, in meters.
+  - feature_tolerance: Optional distance in meters to sample the orchard features to (see
+                       get_orchard_features). By default every tree is used.
+  - tile_size: The width of a tile in meters.
+
+  Returns:
+  - projection: The LocalProjection of the orchard, to convert the missing trees back with.
+  - jobs: A list of the inputs of detect_tile for every tile.
+  """
+  with stage("index"):
+    projection = LocalProjection(all_trees)
+    tree_points = projection.to_local(all_trees)
+    index = SpatialIndex(tree_points, cell_size=precision)
+
+  with stage("features"):
+    features = get_orchard_features(tree_points, index, feature_tolerance)
+
+  with stage("plan_tiles"):
+    origin, tiles = plan_tiles(tree_points, tile_size, tile_halo(features, precision))
+    jobs = [{
+      "tile": tile,
+      "origin": origin,
+      "tile_size": tile_size,
+      "points": tree_points[tree_indices],
+      "tree_indices": tree_indices,
+      "features": features,
+      "precision": precision,
+    } for tile, tree_indices in tiles]
+
+  record_count("trees", len(tree_points))
+  record_count("tiles", len(tiles))
+  return projection, jobs
+
+
+def merge_tiled_detection(projection, results, min_group_size):
+  """
+  Combine the outputs of detect_tile into the missing trees of the orchard.
+
+  Parameters:
+  - projection: The LocalProjection returned by plan_tiled_detection.
+  - results: The outputs of detect_tile for every tile.
+  - min_group_size: How many expected locations should agree for a tree to count as missing.
+
+  Returns:
+  - missing_tree_coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+  """
+  with stage("merge_tiles"):
+    missing_tree_groups = merge_tiles(results, min_group_size)
+
+  record_count("missing_trees", len(missing_tree_groups))
+  missing_tree_points = [missing_tree_group.center() for missing_tree_group in missing_tree_groups]
+  return projection.to_latlng(missing_tree_points)
+
+
+def detect_missing_trees_tiled(all_trees, min_group_size=3, precision=2.5, feature_tolerance=None, tile_size=250.0,
+                               map=map):
+  """
+  Run the missing tree detection pipeline on an orchard split into tiles.
+
+  The orchard features are found once for the whole orchard. The projected orchard is then split
+  into square tiles, each padded with a halo of the trees around it (see tile_halo), and missing
+  trees are found in every tile independently, so that tiles can run in parallel with little
+  memory each. The missing trees are grouped across tile edges when the tiles are merged, and the
+  result is identical to detect_missing_trees.
+
+  The three steps (plan_tiled_detection, detect_tile and merge_tiled_detection) can also be run
+  separately, as the detection pool does to run each of them in a worker process.
+
+  Parameters:
+  - all_trees: TreeSet (or an (N, 2) array) of GPS coordinates (latitude, longitude) of all trees.
+  - min_group_size: How many expected locations should agree for a tree to count as missing.
+  - precision: How close trees should be to a location, or to each other, in meters.
+  - feature_tolerance: Optional distance in meters to sample the orchard features to (see
+                       get_orchard_features). By default every tree is used.
+  - tile_size: The width of a tile in meters.
+  - map: Function used to run detect_tile over the tiles, such as the map of a ProcessPoolExecutor.
+
+  Returns:
+  - missing_tree_coords: (M, 2) array of the GPS coordinates (latitude, longitude) of the missing trees.
+  """
+  projection, jobs = plan_tiled_detection(all_trees, precision, feature_tolerance, tile_size)
+  with stage("tiles"):
+    results = list(map(detect_tile, jobs))
+  return merge_tiled_detection(projection, results, min_group_size)
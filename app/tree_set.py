@@ -0,0 +1,139 @@
+import numpy as np
+
+# Survey fields that are kept for each tree, when the survey has them
+TREE_ATTRIBUTES = ("id", "radius", "ndvi", "height")
+
+
+class Tree:
+  """
+  A single tree of a TreeSet.
+
+  This is a lightweight view of one row of the set rather than a copy of its values. Two trees are
+  the same if they are the same row of the same set, so identity never depends on comparing floats.
+  A tree can still be unpacked like a (lat, lng) tuple.
+  """
+
+  __slots__ = ("tree_set", "index")
+
+  def __init__(self, tree_set, index):
+    self.tree_set = tree_set
+    self.index = index
+
+  @property
+  def lat(self):
+    return float(self.tree_set.coords[self.index, 0])
+
+  @property
+  def lng(self):
+    return float(self.tree_set.coords[self.index, 1])
+
+  def __getattr__(self, name):
+    if name in Tree.__slots__:
+      raise AttributeError(name)
+    attributes = self.tree_set.attributes
+    if name not in attributes:
+      raise AttributeError(name)
+    return attributes[name][self.index].item()
+
+  def __iter__(self):
+    yield self.lat
+    yield self.lng
+
+  def __len__(self):
+    return 2
+
+  def __getitem__(self, i):
+    return (self.lat, self.lng)[i]
+
+  def __eq__(self, other):
+    return isinstance(other, Tree) and self.tree_set is other.tree_set and self.index == other.index
+
+  def __hash__(self):
+    return hash((id(self.tree_set), self.index))
+
+  def __repr__(self):
+    return f"Tree({self.lat}, {self.lng})"
+
+
+class TreeSet:
+  """
+  A columnar set of trees.
+
+  The locations are held in one contiguous (N, 2) float64 array, and any other per-tree values from
+  the survey (such as id, radius, ndvi and height) are held as (N,) arrays alongside them. Trees are
+  identified by their index in the set rather than by their coordinates.
+
+  Slicing a set gives a view of the same arrays without copying them. Indexing it with an array of
+  indices or a boolean mask gives a new set of just those trees. A set can be passed anywhere an
+  (N, 2) array of coordinates is expected.
+  """
+
+  __slots__ = ("coords", "attributes")
+
+  def __init__(self, coords, attributes=None):
+    """
+    Create the set.
+
+    Parameters:
+    - coords: (N, 2) array (or a list of tuples) of the locations of the trees, either GPS coordinates
+              (latitude, longitude) or points in a local frame (north, east).
+    - attributes: Optional dictionary of (N,) arrays of other values of each tree.
+    """
+    self.coords = np.ascontiguousarray(coords, dtype=np.float64).reshape(-1, 2)
+    self.attributes = {name: np.asarray(values) for name, values in (attributes or {}).items()}
+
+  @classmethod
+  def concatenate(cls, tree_sets):
+    """
+    Join sets of trees end to end, keeping the attributes that every set has.
+    """
+    tree_sets = list(tree_sets)
+    names = set.intersection(*(set(tree_set.attributes) for tree_set in tree_sets)) if tree_sets else ()
+    return cls(
+      np.concatenate([tree_set.coords for tree_set in tree_sets]) if tree_sets else np.empty((0, 2)),
+      {name: np.concatenate([tree_set.attributes[name] for tree_set in tree_sets]) for name in sorted(names)})
+
+  @property
+  def lat(self):
+    return self.coords[:, 0]
+
+  @property
+  def lng(self):
+    return self.coords[:, 1]
+
+  def __len__(self):
+    return len(self.coords)
+
+  def __array__(self, dtype=None, copy=None):
+    return self.coords if dtype is None else self.coords.astype(dtype, copy=False)
+
+  def __iter__(self):
+    return (Tree(self, i) for i in range(len(self)))
+
+  def __getitem__(self, key):
+    if isinstance(key, (int, np.integer)):
+      return Tree(self, range(len(self))[key])
+    return TreeSet(self.coords[key], {name: values[key] for name, values in self.attributes.items()})
+
+  def __repr__(self):
+    return f"TreeSet({len(self)} trees, attributes={sorted(self.attributes)})"
+
+  def with_coords(self, coords):
+    """
+    Get a set of the same trees at other coordinates, such as projected into a local frame,
+    sharing this set's attributes.
+    """
+    return TreeSet(coords, self.attributes)
+
+  def center(self):
+    """
+    Get the center of the trees.
+
+    Returns:
+    - coordinate: A tuple of the average coordinates of the trees.
+    """
+    return tuple(self.coords.mean(axis=0).tolist())
+
+  @property
+  def nbytes(self):
+    return self.coords.nbytes + sum(values.nbytes for values in self.attributes.values())
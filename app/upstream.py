@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import math
+import httpx
+import ijson
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from app.metrics import stage
+from app.survey_parser import SurveyParser, concatenate_pages
+
+# Upstream responses that are worth retrying, since they are usually temporary
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+logger = logging.getLogger(__name__)
+
+
+class AeroboticsClient:
+    """
+    A shared async client for the Aerobotics API.
+
+    A single client should be created when the server starts and reused by every request, so that
+    connections to the API are pooled and kept alive instead of being set up for every call.
+    """
+
+    def __init__(self, base_url, api_key, timeout=10.0, connect_timeout=5.0, max_connections=100,
+                 max_keepalive_connections=20, keepalive_expiry=30.0, retries=3, backoff=0.5,
+                 max_pages_in_flight=8, transport=None):
+        """
+        Create the client.
+
+        Parameters:
+        - base_url: The root URL of the API. Point this at a local stub server to test against it.
+        - api_key: The key sent in the Authorization header.
+        - timeout: Seconds to wait for a response, or between chunks of a response.
+        - connect_timeout: Seconds to wait for a connection to the API.
+        - max_connections: The most connections that can be open to the API at once.
+        - max_keepalive_connections: The most idle connections that are kept open for reuse.
+        - keepalive_expiry: Seconds an idle connection is kept open for.
+        - retries: How many times a failed call is retried.
+        - backoff: Seconds to wait before the first retry. This doubles for every later retry.
+        - max_pages_in_flight: The most pages of a paginated endpoint that are fetched at once.
+        - transport: Optional httpx transport to send the requests through.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_pages_in_flight = max_pages_in_flight
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+        self.pages = 0
+        self.bytes = 0
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"Authorization": api_key or "", "accept": "application/json"},
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry),
+            transport=transport)
+
+    async def _request(self, path, params, read):
+        """
+        Make a streamed GET request to the API, retrying with exponential backoff if it fails.
+
+        Parameters:
+        - path: The path of the endpoint relative to the base URL, or a full URL.
+        - params: Optional dictionary of query parameters.
+        - read: Coroutine function that reads the successful response as it streams in.
+
+        Returns:
+        - The result of `read`.
+
+        Raises:
+        - httpx.HTTPError: If the request still fails after all of the retries.
+        """
+        for attempt in range(self.retries + 1):
+            self.requests += 1
+            try:
+                async with self.client.stream("GET", path, params=params) as response:
+                    if response.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                        response.raise_for_status()
+                        return await read(response)
+            except httpx.HTTPStatusError:
+                self.failures += 1
+                raise
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    self.failures += 1
+                    raise
+            self.retried += 1
+            logger.warning("Retrying a request to the Aerobotics API", extra={"path": str(path), "attempt": attempt + 1})
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def get(self, path, params=None):
+        """
+        Make a GET request to the API, retrying with exponential backoff if it fails.
+
+        Parameters:
+        - path: The path of the endpoint, relative to the base URL.
+        - params: Optional dictionary of query parameters.
+
+        Returns:
+        - response: The successful httpx.Response, with its body read.
+        """
+        async def read(response):
+            await response.aread()
+            return response
+
+        return await self._request(path, params, read)
+
+    async def get_survey_page(self, path, params=None, fields=(), page_size=None):
+        """
+        Fetch a page of tree survey results, parsing the body as it streams in.
+
+        Parameters:
+        - path: The path of the endpoint relative to the base URL, or a full URL.
+        - params: Optional dictionary of query parameters.
+        - fields: Optional names of other numeric fields of each tree to keep.
+        - page_size: Optional number of results the page is expected to hold (see SurveyParser).
+
+        Returns:
+        - page: The parsed page, as returned by SurveyParser.close.
+
+        Raises:
+        - httpx.DecodingError: If the body is not a valid page of survey results. This is not retried.
+        """
+        async def read(response):
+            parser = SurveyParser(fields, page_size)
+            try:
+                async for chunk in response.aiter_bytes():
+                    self.bytes += len(chunk)
+                    with stage("decode"):
+                        parser.feed(chunk)
+                with stage("decode"):
+                    page = parser.close()
+            except (ijson.JSONError, ValueError, TypeError) as e:
+                self.failures += 1
+                raise httpx.DecodingError(f"Could not parse the survey page: {e}", request=response.request) from e
+            self.pages += 1
+            return page
+
+        return await self._request(path, params, read)
+
+    async def get_survey(self, path, params=None, fields=()):
+        """
+        Fetch every page of tree survey results.
+
+        The first page is fetched on its own to find the total `count` and the pagination scheme
+        from its `next` link. The remaining pages are then fetched concurrently, with at most
+        `max_pages_in_flight` requests open at once, and their results are combined in order. If
+        the first page has no `count`, or the scheme cannot be worked out from the `next` link, the
+        pages are followed one by one.
+
+        Parameters:
+        - path: The path of the endpoint, relative to the base URL.
+        - params: Optional dictionary of query parameters.
+        - fields: Optional names of other numeric fields of each tree to keep.
+
+        Returns:
+        - survey: The combined results of every page, as returned by SurveyParser.close.
+        """
+        first_page = await self.get_survey_page(path, params, fields)
+        pages = [first_page]
+        next_url = first_page["next"]
+        if not next_url or not first_page["results"]:
+            return concatenate_pages(pages)
+
+        # Trees without coordinates are dropped from the page, but still take up a place on it
+        page_size = first_page["results"]
+        # Without the total count, the number of pages is unknown, so they can only be followed in turn
+        page_urls = None
+        if first_page["count"] is not None:
+            page_urls = remaining_page_urls(next_url, first_page["count"], page_size)
+        if page_urls is None:
+            while next_url:
+                pages.append(await self.get_survey_page(next_url, fields=fields, page_size=page_size))
+                next_url = pages[-1]["next"]
+            return concatenate_pages(pages)
+
+        in_flight = asyncio.Semaphore(self.max_pages_in_flight)
+
+        async def fetch_page(url):
+            async with in_flight:
+                return await self.get_survey_page(url, fields=fields, page_size=page_size)
+
+        pages += await asyncio.gather(*(fetch_page(url) for url in page_urls))
+        return concatenate_pages(pages)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self):
+        """
+        Get the counters of the client.
+
+        Returns:
+        - stats: A dictionary of the number of requests made (including retries), requests retried,
+                 calls that failed after every retry, survey pages parsed, and bytes of survey pages read.
+        """
+        return {
+            "requests": self.requests,
+            "retried": self.retried,
+            "failures": self.failures,
+            "pages": self.pages,
+            "bytes": self.bytes,
+        }
+
+
+def remaining_page_urls(next_url, count, page_size):
+    """
+    Work out the URLs of every page after the first from the `next` link of the first page.
+
+    Both page number (`page`) and limit/offset (`limit`, `offset`) pagination are supported.
+
+    Parameters:
+    - next_url: The `next` link of the first page.
+    - count: The total number of results.
+    - page_size: The number of results on the first page.
+
+    Returns:
+    - urls: A list of the URLs of the remaining pages in order, or None if the pagination scheme
+            is not recognised.
+    """
+    parts = urlsplit(next_url)
+    query = dict(parse_qsl(parts.query))
+
+    if 'offset' in query:
+        limit = int(query.get('limit', page_size))
+        pages = [{**query, 'offset': offset} for offset in range(int(query['offset']), count, limit)]
+    elif 'page' in query:
+        size = int(query.get('page_size', page_size))
+        last_page = math.ceil(count / size)
+        pages = [{**query, 'page': page} for page in range(int(query['page']), last_page + 1)]
+    else:
+        return None
+
+    return [urlunsplit(parts._replace(query=urlencode(page))) for page in pages]
@@ -0,0 +1,234 @@
+"""
+Time each stage of the missing tree detection pipeline on synthetic orchards of growing size.
+
+> python -m benchmark
+> python -m benchmark --sizes 100 1000 10000 100000 1000000 --repeat 1
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import httpx
+import numpy as np
+from app.orchard_utils import (
+  detect_missing_trees, detect_missing_trees_converged, find_missing_trees, find_tree_groups, get_orchard_features)
+from app.projection import LocalProjection
+from app.spatial_index import SpatialIndex
+from benchmark.synthetic import PATTERNS, generate_orchard
+
+STAGES = ("index", "features", "missing_trees", "groups", "pipeline", "converged", "endpoint")
+
+
+def best_time(function, repeat):
+  """
+  Run a function several times.
+
+  Returns:
+  - seconds: The fastest run, in seconds.
+  - result: What the last run returned.
+  """
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = function()
+    times.append(time.perf_counter() - start)
+  return min(times), result
+
+
+def time_stages(trees, repeat, min_group_size, precision, feature_tolerance):
+  """
+  Time the stages of detect_missing_trees separately, each on the output of the one before.
+
+  Returns:
+  - times: A dictionary of the fastest time of each stage, in seconds.
+  - found: A dictionary of the GPS coordinates of the missing trees found by the full pipeline, in
+           one pass and converged.
+  """
+  times = {}
+  projection = LocalProjection(trees)
+  tree_points = projection.to_local(trees)
+  times["index"], index = best_time(lambda: SpatialIndex(tree_points, cell_size=precision), repeat)
+  times["features"], features = best_time(lambda: get_orchard_features(tree_points, index, feature_tolerance), repeat)
+  times["missing_trees"], missing_trees = best_time(
+    lambda: find_missing_trees(tree_points, features, index, precision=precision), repeat)
+  times["groups"], _ = best_time(lambda: find_tree_groups(missing_trees, min_group_size, precision), repeat)
+  times["pipeline"], missing_tree_coords = best_time(
+    lambda: detect_missing_trees(trees, min_group_size, precision, feature_tolerance), repeat)
+  times["converged"], (converged_coords, _) = best_time(
+    lambda: detect_missing_trees_converged(trees, min_group_size, precision, feature_tolerance), repeat)
+  return times, {"pipeline": missing_tree_coords, "converged": converged_coords}
+
+
+class AppClient:
+  """
+  Sends requests to an ASGI app in this process through httpx, so no network or test client is
+  needed. The app's startup handlers are run when the block is entered, and its shutdown handlers
+  when it is left.
+  """
+
+  def __init__(self, app):
+    self.app = app
+    self.loop = asyncio.new_event_loop()
+    self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark")
+
+  def __enter__(self):
+    self.loop.run_until_complete(self.app.router.startup())
+    return self
+
+  def __exit__(self, *exc_info):
+    self.loop.run_until_complete(self.client.aclose())
+    self.loop.run_until_complete(self.app.router.shutdown())
+    self.loop.close()
+
+  def get(self, url, **kwargs):
+    return self.loop.run_until_complete(self.client.get(url, **kwargs))
+
+
+def time_endpoint(client, store, orchard_id, trees, repeat, engine):
+  """
+  Time the missing trees endpoint on an orchard served from a survey store, so no network is used.
+
+  Each run uses a new orchard id, so it is not answered from the result cache.
+
+  Returns:
+  - seconds: The fastest request, in seconds.
+  - missing_tree_coords: The GPS coordinates of the missing trees in the last response.
+  """
+  times = []
+  for run in range(repeat):
+    run_id = orchard_id * 1000 + run
+    store.put(run_id, {"count": len(trees), "next": None, "survey_id": run_id, "trees": trees})
+    start = time.perf_counter()
+    response = client.get(f"/orchards/{run_id}/missing-trees", params={"engine": engine})
+    times.append(time.perf_counter() - start)
+    response.raise_for_status()
+  missing_trees = response.json()["missing_trees"]
+  return min(times), np.array([(tree["lat"], tree["lng"]) for tree in missing_trees]).reshape(-1, 2)
+
+
+def score(found, orchard, projection, precision):
+  """
+  Check how many of the removed trees of a synthetic orchard were found.
+
+  A removed tree is found if a missing tree was reported within `precision` of it.
+
+  Returns:
+  - recall: A dictionary of the fraction of the removed trees found, overall and for each pattern.
+  - precision: The fraction of the reported missing trees that were removed trees.
+  """
+  if not len(orchard["missing"]):
+    return {"all": 1.0}, 1.0 if not len(found) else 0.0
+  found_points = projection.to_local(found)
+  missing_points = projection.to_local(orchard["missing"])
+  missing_found = np.zeros(len(missing_points), dtype=bool)
+  found_correct = np.zeros(len(found_points), dtype=bool)
+  if len(found_points):
+    index = SpatialIndex(found_points, cell_size=precision)
+    missing_indices, found_indices, _ = index.within_many(missing_points, precision)
+    missing_found[missing_indices] = True
+    found_correct[found_indices] = True
+
+  recall = {"all": float(missing_found.mean())}
+  for name in np.unique(orchard["missing_patterns"]).tolist():
+    recall[name] = float(missing_found[orchard["missing_patterns"] == name].mean())
+  return recall, float(found_correct.mean()) if len(found_points) else 0.0
+
+
+def scaling_exponent(sizes, times):
+  """
+  Fit time = a * size^k over the sizes measured.
+
+  Returns:
+  - k: The exponent, which is 1 for a stage that scales linearly.
+  """
+  if len(sizes) < 2:
+    return float("nan")
+  return float(np.polyfit(np.log(sizes), np.log(np.maximum(times, 1e-9)), 1)[0])
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+  parser.add_argument("--repeat", type=int, default=3, help="Runs of each stage; the fastest is reported")
+  parser.add_argument("--angle", type=float, default=20.0, help="Direction of the rows, in degrees east of north")
+  parser.add_argument("--row-spacing", type=float, default=6.0)
+  parser.add_argument("--tree-spacing", type=float, default=4.0)
+  parser.add_argument("--jitter", type=float, default=0.15, help="Standard deviation of tree positions, in meters")
+  parser.add_argument("--missing-fraction", type=float, default=0.01)
+  parser.add_argument("--patterns", nargs="+", choices=sorted(PATTERNS), default=list(PATTERNS))
+  parser.add_argument("--feature-tolerance", type=float, default=0.01, help="0 uses every tree")
+  parser.add_argument("--engine", choices=("neighbours", "lattice"), default="neighbours",
+                      help="Detector used by the endpoint")
+  parser.add_argument("--no-endpoint", action="store_true", help="Skip timing the endpoint")
+  parser.add_argument("--min-recall", type=float, default=0.9,
+                      help="Fail if the converged pipeline finds less than this fraction of the removed trees")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--json", help="Also write the results to this file")
+  args = parser.parse_args()
+
+  min_group_size, precision = 3, 2.5
+  feature_tolerance = args.feature_tolerance or None
+
+  client = store = None
+  if not args.no_endpoint:
+    # The server reads its configuration when it is imported, so the survey store has to be set up first
+    directory = tempfile.mkdtemp(prefix="orchard-benchmark-")
+    os.environ.update(SURVEY_STORE_DIR=directory, SURVEY_STORE_TTL="0",
+                      FEATURE_TOLERANCE=str(args.feature_tolerance), LOG_LEVEL="WARNING")
+    from app.main import app, survey_store
+    client, store = AppClient(app).__enter__(), survey_store
+
+  results = []
+  print(f"{'trees':>9} " + " ".join(f"{stage:>13}" for stage in STAGES) + f" {'recall':>15} {'precision':>15}")
+  try:
+    for i, size in enumerate(args.sizes):
+      orchard = generate_orchard(
+        size, row_spacing=args.row_spacing, tree_spacing=args.tree_spacing, angle=args.angle,
+        jitter=args.jitter, missing_fraction=args.missing_fraction, patterns=args.patterns, seed=args.seed)
+      trees = orchard["trees"]
+      times, found = time_stages(trees, args.repeat, min_group_size, precision, feature_tolerance)
+      if client is not None:
+        times["endpoint"], _ = time_endpoint(client, store, i + 1, trees, args.repeat, args.engine)
+
+      projection = LocalProjection(trees)
+      scores = {mode: score(coords, orchard, projection, precision) for mode, coords in found.items()}
+      results.append({
+        "trees": len(trees),
+        "missing": len(orchard["missing"]),
+        "times": times,
+        "recall": {mode: recall for mode, (recall, _) in scores.items()},
+        "precision": {mode: found_precision for mode, (_, found_precision) in scores.items()},
+      })
+      recall = "/".join(f"{scores[mode][0]['all']:.3f}" for mode in ("pipeline", "converged"))
+      found_precision = "/".join(f"{scores[mode][1]:.3f}" for mode in ("pipeline", "converged"))
+      print(f"{len(trees):>9} " + " ".join(f"{times[stage]:>12.4f}s" if stage in times else f"{'-':>13}"
+                                           for stage in STAGES) + f" {recall:>15} {found_precision:>15}")
+  finally:
+    if client is not None:
+      client.__exit__(None, None, None)
+
+  sizes = [result["trees"] for result in results]
+  exponents = {stage: scaling_exponent(sizes, [result["times"][stage] for result in results])
+               for stage in STAGES if all(stage in result["times"] for result in results)}
+  print(f"{'scaling':>9} " + " ".join(f"{'n^%.2f' % exponents[stage]:>13}" if stage in exponents else f"{'-':>13}"
+                                      for stage in STAGES))
+  print("recall and precision are of the pipeline in one pass / converged")
+  for name in sorted({name for result in results for name in result["recall"]["pipeline"]} - {"all"}):
+    print(f"recall of {name} patterns: " + ", ".join(
+      "/".join(f"{result['recall'][mode].get(name, float('nan')):.3f}" for mode in ("pipeline", "converged"))
+      for result in results))
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump({"arguments": vars(args), "results": results, "scaling": exponents}, f, indent=2)
+
+  failed = [result["trees"] for result in results if result["recall"]["converged"]["all"] < args.min_recall]
+  if failed:
+    print(f"Recall below {args.min_recall} for orchards of {failed} trees", file=sys.stderr)
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,96 @@
+import numpy as np
+from app.geodesy import EARTH_RADIUS
+from app.tree_set import TreeSet
+
+# Cells (row, tree) left empty by each pattern of missing trees, relative to where it is placed
+PATTERNS = {
+  "single": ((0, 0),),
+  "run": ((0, 0), (0, 1), (0, 2)),
+  "corner": ((0, 0), (0, 1), (1, 0)),
+}
+
+
+def orchard_shape(num_trees, aspect=1.5):
+  """
+  Get the number of rows and trees per row of an orchard of about `num_trees` trees.
+
+  Parameters:
+  - num_trees: How many trees the orchard should have.
+  - aspect: How many times longer a row is than the block is wide, in trees.
+
+  Returns:
+  - rows: The number of rows.
+  - columns: The number of trees in each row.
+  """
+  rows = max(int(round(np.sqrt(num_trees / aspect))), 1)
+  return rows, max(int(np.ceil(num_trees / rows)), 1)
+
+
+def generate_orchard(num_trees=10000, row_spacing=6.0, tree_spacing=4.0, angle=20.0, jitter=0.15,
+                     missing_fraction=0.01, patterns=tuple(PATTERNS), aspect=1.5, origin=(-32.3279, 18.8268),
+                     seed=0):
+  """
+  Generate a synthetic orchard with known missing trees.
+
+  The trees are planted on a grid of rows rotated by `angle`, moved by a random jitter, and then
+  some of them are removed in the given patterns. Each pattern is placed in its own block of cells
+  with at least two trees on every side of it, so every missing tree is inside the orchard and
+  patterns never touch each other.
+
+  Parameters:
+  - num_trees: About how many trees the orchard should have, before any are removed.
+  - row_spacing: The distance between rows, in meters.
+  - tree_spacing: The distance between trees along a row, in meters.
+  - angle: The direction of the rows, in degrees east of north.
+  - jitter: The standard deviation of the position of each tree, in meters.
+  - missing_fraction: About what fraction of the trees to remove.
+  - patterns: Names of the patterns (see PATTERNS) to remove trees in, used in turn.
+  - aspect: How many times longer a row is than the block is wide, in trees.
+  - origin: The GPS coordinates (latitude, longitude) of the first tree.
+  - seed: Seed of the random generator, so the same orchard can be generated again.
+
+  Returns:
+  - orchard: A dictionary of the `trees` as a TreeSet of GPS coordinates with an `id` attribute,
+             the `missing` (M, 2) array of the GPS coordinates of the removed trees, the
+             `missing_patterns` (M,) array of the pattern each was removed in, and the `shape`
+             (rows, columns) of the grid.
+  """
+  rng = np.random.default_rng(seed)
+  rows, columns = orchard_shape(num_trees, aspect)
+
+  # Lay the patterns out in blocks of cells, two cells in from each side of the block
+  size = max(max(max(cell) for cell in PATTERNS[name]) for name in patterns) + 5
+  blocks = np.array([(row, column) for row in range(0, rows - size + 1, size)
+                     for column in range(0, columns - size + 1, size)]).reshape(-1, 2)
+  mean_pattern_size = np.mean([len(PATTERNS[name]) for name in patterns])
+  num_patterns = min(int(round(missing_fraction * rows * columns / mean_pattern_size)), len(blocks))
+  blocks = blocks[np.sort(rng.choice(len(blocks), num_patterns, replace=False))]
+
+  missing_cells, missing_patterns = [], []
+  for i, block in enumerate(blocks):
+    name = patterns[i % len(patterns)]
+    missing_cells.extend(block + 2 + np.array(PATTERNS[name]))
+    missing_patterns.extend([name] * len(PATTERNS[name]))
+  missing_cells = np.array(missing_cells, dtype=np.int64).reshape(-1, 2)
+
+  cells = np.stack(np.meshgrid(np.arange(rows), np.arange(columns), indexing="ij"), axis=-1).reshape(-1, 2)
+  present = np.ones(len(cells), dtype=bool)
+  present[missing_cells[:, 0] * columns + missing_cells[:, 1]] = False
+
+  theta = np.radians(angle)
+  along_row = tree_spacing * np.array([np.cos(theta), np.sin(theta)])
+  across_rows = row_spacing * np.array([-np.sin(theta), np.cos(theta)])
+
+  def to_latlng(cells, jitter=0.0):
+    points = cells[:, :1] * across_rows + cells[:, 1:] * along_row
+    points = points + rng.normal(0.0, jitter, points.shape) if jitter else points
+    scale = np.array([EARTH_RADIUS, EARTH_RADIUS * np.cos(np.radians(origin[0]))])
+    return np.asarray(origin) + np.degrees(points / scale)
+
+  trees = TreeSet(to_latlng(cells[present], jitter), {"id": np.flatnonzero(present).astype(np.float64)})
+  return {
+    "trees": trees,
+    "missing": to_latlng(missing_cells),
+    "missing_patterns": np.array(missing_patterns, dtype=str),
+    "shape": (rows, columns),
+  }
@@ -0,0 +1,61 @@
+from app.cache import LRUCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_evicts_the_least_recently_used_entry():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.get("b", "missing") == "missing"
+    assert cache.stats() == {
+        "size": 2, "max_size": 2, "ttl": None, "hits": 3, "misses": 1, "evictions": 1, "expiries": 0}
+
+
+def test_setting_an_entry_again_marks_it_as_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("a", 10)
+    cache.set("c", 3)
+    assert cache.get("a") == 10 and "b" not in cache
+    assert cache.evictions == 1
+
+
+def test_expires_entries_after_the_ttl():
+    clock = FakeClock()
+    cache = LRUCache(max_size=10, ttl=60, clock=clock)
+    cache.set("a", 1)
+    clock.now = 30
+    cache.set("b", 2)
+
+    clock.now = 60
+    assert cache.get("a") == 1
+    clock.now = 60.5
+    assert cache.get("a") is None and cache.get("b") == 2
+    clock.now = 91
+    assert "b" not in cache
+
+    assert len(cache) == 0
+    assert cache.stats()["expiries"] == 2 and cache.stats()["misses"] == 1 and cache.stats()["hits"] == 2
+
+
+def test_getting_an_entry_does_not_extend_its_ttl():
+    clock = FakeClock()
+    cache = LRUCache(ttl=10, clock=clock)
+    cache.set("a", 1)
+    clock.now = 9
+    assert cache.get("a") == 1
+    clock.now = 11
+    assert cache.get("a") is None
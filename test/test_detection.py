@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from app.geodesy import as_coords
+from app.incremental import OrchardState
+from app.orchard_utils import (
+  detect_missing_trees, detect_missing_trees_converged, find_missing_trees, find_tree_groups, get_orchard_features)
+from app.projection import LocalProjection
+from app.spatial_index import SpatialIndex
+from app.tiling import detect_missing_trees_tiled
+from benchmark.synthetic import generate_orchard
+
+MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE = 3, 2.5, 0.01
+
+
+def sorted_coords(coords):
+  coords = as_coords(coords)
+  return coords[np.lexsort((coords[:, 1], coords[:, 0]))]
+
+
+def missing_tree_points(points, features):
+  # One pass of the pipeline over trees already projected, with the given orchard features
+  index = SpatialIndex(points, cell_size=PRECISION)
+  groups = find_tree_groups(find_missing_trees(points, features, index, PRECISION), MIN_GROUP_SIZE, PRECISION)
+  centres = as_coords([group.center() for group in groups])
+  return centres, index
+
+
+def test_tiled_matches_untiled():
+  trees = generate_orchard(5000, seed=1)["trees"]
+  expected = detect_missing_trees(trees, MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE)
+  # Tiles much smaller than the orchard, so that many missing trees are grouped across tile edges
+  found = detect_missing_trees_tiled(trees, MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE, tile_size=40.0)
+  assert len(expected)
+  np.testing.assert_array_equal(found, expected)
+
+
+def test_converged_matches_rerunning_the_pipeline():
+  trees = generate_orchard(5000, seed=2)["trees"]
+  found, iterations = detect_missing_trees_converged(trees, MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE)
+
+  # Add the missing trees of each pass back into the orchard and run the whole pipeline again
+  projection = LocalProjection(trees)
+  points = projection.to_local(trees)
+  features = get_orchard_features(points, SpatialIndex(points, cell_size=PRECISION), FEATURE_TOLERANCE)
+  rerun = []
+  for _ in range(iterations):
+    centres, index = missing_tree_points(points, features)
+    new_trees = centres[~index.any_within_many(centres, PRECISION)]
+    rerun.append(new_trees)
+    points = np.concatenate([points, new_trees])
+
+  assert iterations > 1 and not len(rerun[-1])
+  np.testing.assert_allclose(
+    sorted_coords(found), sorted_coords(projection.to_latlng(np.concatenate(rerun))), rtol=0, atol=1e-9)
+
+
+def test_incremental_matches_full():
+  orchard = generate_orchard(5000, seed=3)
+  trees = orchard["trees"]
+  state = OrchardState(trees, MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE, survey_id=1)
+  np.testing.assert_allclose(
+    state.missing_tree_coords(), detect_missing_trees(trees, MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE),
+    rtol=0, atol=1e-9)
+
+  # Remove some trees, as if they had died since the first survey
+  keep = np.ones(len(trees), dtype=bool)
+  keep[np.random.default_rng(0).choice(len(trees), 20, replace=False)] = False
+  survey = trees[keep]
+  diff = state.update(survey, survey_id=2)
+  assert diff["removed"] == 20 and diff["added"] == 0
+  # The projection and orchard features are kept from the first survey, so the full pipeline uses them too
+  centres, _ = missing_tree_points(state.projection.to_local(survey), state.features)
+  np.testing.assert_allclose(
+    sorted_coords(state.missing_tree_coords()), sorted_coords(state.projection.to_latlng(centres)), rtol=0, atol=1e-9)
+
+
+def test_incremental_skips_the_same_survey():
+  trees = generate_orchard(1000, seed=4)["trees"]
+  state = OrchardState(trees, MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE, survey_id=1)
+  missing_tree_coords = state.missing_tree_coords()
+  diff = state.update(trees[:500], survey_id=1)
+  assert diff["matched_by"] == "survey_id" and diff["locations_changed"] == 0
+  np.testing.assert_array_equal(state.missing_tree_coords(), missing_tree_coords)
+
+
+def test_empty_orchard_raises_value_error():
+  with pytest.raises(ValueError):
+    detect_missing_trees(np.empty((0, 2)), MIN_GROUP_SIZE, PRECISION, FEATURE_TOLERANCE)
@@ -0,0 +1,34 @@
+import io
+import json
+import logging
+from app.logs import setup_logging
+
+
+def read_lines(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_logs_are_written_as_json_and_sampled():
+    stream = io.StringIO()
+    queued_logging = setup_logging(("test_logs.sampled",), sample_rate=0.0, stream=stream)
+    logger = logging.getLogger("test_logs.sampled.child")
+    logger.info("Found missing trees", extra={"orchard_id": 1, "sampled": True})
+    logger.warning("Could not fetch the orchard survey", extra={"orchard_id": 2})
+    queued_logging.stop()
+
+    lines = read_lines(stream)
+    assert [line["message"] for line in lines] == ["Could not fetch the orchard survey"]
+    assert lines[0]["orchard_id"] == 2 and lines[0]["logger"] == "test_logs.sampled.child"
+
+
+def test_records_logged_after_stopping_are_still_written():
+    stream = io.StringIO()
+    queued_logging = setup_logging(
+        ("test_logs.server", "test_logs.access"), stream=stream, sample_rate=0.0, sampled=("test_logs.access",))
+    logging.getLogger("test_logs.server").info("Waiting for application shutdown.")
+    queued_logging.stop()
+    logging.getLogger("test_logs.server").info("Finished server process")
+    logging.getLogger("test_logs.access").info("GET / 200")
+
+    assert [line["message"] for line in read_lines(stream)] == [
+        "Waiting for application shutdown.", "Finished server process"]
@@ -0,0 +1,84 @@
+import gzip
+import json
+import numpy as np
+import pytest
+from app.serialisation import (
+    COLUMNAR, GEOJSON, JSON, accepts_gzip, missing_trees_columnar, missing_trees_geojson, missing_trees_json,
+    missing_trees_response, negotiate_media_type, read_missing_trees_columnar)
+
+COORDS = np.array([[-32.328897, 18.82585567], [-32.32879065, 18.82643249], [0.1 + 0.2, -1e-7]])
+
+
+@pytest.mark.parametrize("accept, media_type", [
+    (None, JSON),
+    ("", JSON),
+    ("*/*", JSON),
+    ("application/*", JSON),
+    ("application/geo+json", GEOJSON),
+    ("application/json;q=0.5, application/geo+json", GEOJSON),
+    ("application/geo+json;q=0.5, */*", JSON),
+    ("text/html, application/x-missing-trees-float64;q=0.9", COLUMNAR),
+    ("application/json;q=0, */*;q=0.5", None),
+    ("application/json;q=0, application/geo+json;q=0.1, */*", GEOJSON),
+    ("Application/JSON", JSON),
+    ("text/html", None),
+    ("application/json;q=0", None),
+])
+def test_negotiate_media_type(accept, media_type):
+    assert negotiate_media_type(accept) == media_type
+
+
+@pytest.mark.parametrize("accept_encoding, accepted", [
+    (None, False),
+    ("", False),
+    ("gzip", True),
+    ("br, GZIP;q=0.5", True),
+    ("gzip;q=0", False),
+    ("gzip;q=0, *", False),
+    ("*", True),
+    ("*;q=0", False),
+    ("identity", False),
+])
+def test_accepts_gzip(accept_encoding, accepted):
+    assert accepts_gzip(accept_encoding) is accepted
+
+
+def test_json_matches_json_dumps():
+    fields = {"orchard_id": 216269, "iterations": None}
+    expected = {**fields, "missing_trees": [{"lat": lat, "lng": lng} for lat, lng in COORDS.tolist()]}
+    assert missing_trees_json(fields, COORDS) == json.dumps(expected, separators=(",", ":")).encode()
+    assert json.loads(missing_trees_json({}, np.empty((0, 2)))) == {"missing_trees": []}
+
+
+def test_geojson_coordinates_are_longitude_first():
+    feature = json.loads(missing_trees_geojson({"orchard_id": 1}, COORDS))
+    assert feature["geometry"]["coordinates"] == COORDS[:, ::-1].tolist()
+    assert feature["properties"] == {"orchard_id": 1}
+
+
+@pytest.mark.parametrize("fields, coords", [
+    ({"orchard_id": 216269}, COORDS),
+    ({"orchard_id": 1, "diff": {"added": 2}}, COORDS[:1]),
+    ({}, np.empty((0, 2))),
+])
+def test_columnar_round_trip(fields, coords):
+    body = missing_trees_columnar(fields, coords)
+    assert len(body) % 8 == 0
+    read_fields, read_coords = read_missing_trees_columnar(body)
+    assert read_fields == fields
+    np.testing.assert_array_equal(read_coords, coords)
+
+
+def test_columnar_rejects_other_bodies():
+    with pytest.raises(ValueError):
+        read_missing_trees_columnar(missing_trees_json({}, COORDS).ljust(16))
+
+
+def test_response_is_gzipped_when_accepted():
+    coords = np.repeat(COORDS, 50, axis=0)
+    response = missing_trees_response({"orchard_id": 1}, coords, JSON, "gzip")
+    assert response.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(response.body) == missing_trees_json({"orchard_id": 1}, coords)
+
+    response = missing_trees_response({"orchard_id": 1}, coords, JSON, "gzip;q=0, *")
+    assert "content-encoding" not in response.headers
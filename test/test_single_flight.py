@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+from app.single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    async def run():
+        flights = SingleFlight()
+        started = []
+        release = asyncio.Event()
+
+        async def work(value):
+            started.append(value)
+            await release.wait()
+            return value * 2
+
+        callers = [asyncio.ensure_future(flights.run("key", work, value)) for value in (1, 2, 3)]
+        other = asyncio.ensure_future(flights.run("other", work, 10))
+        await asyncio.sleep(0)
+        stats = flights.stats()
+        release.set()
+        return await asyncio.gather(*callers, other), started, stats, flights.stats()
+
+    results, started, during, after = asyncio.run(run())
+    assert results == [2, 2, 2, 20]
+    assert started == [1, 10]
+    assert during == {"in_flight": 2, "waiting": 2, "leaders": 2, "coalesced": 2}
+    assert after == {"in_flight": 0, "waiting": 0, "leaders": 2, "coalesced": 2}
+
+
+def test_calls_after_the_work_finishes_start_it_again():
+    async def run():
+        flights = SingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(None)
+            return len(calls)
+
+        return await flights.run("key", work), await flights.run("key", work), flights.stats()
+
+    first, second, stats = asyncio.run(run())
+    assert (first, second) == (1, 2)
+    assert stats["leaders"] == 2 and stats["coalesced"] == 0
+
+
+def test_exceptions_are_raised_to_every_caller():
+    async def run():
+        flights = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0)
+            raise ValueError("Could not find trees on both major axes of the orchard")
+
+        callers = [flights.run("key", work) for _ in range(3)]
+        return await asyncio.gather(*callers, return_exceptions=True), flights.stats()
+
+    results, stats = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert stats["in_flight"] == 0
+
+
+def test_a_cancelled_caller_does_not_cancel_the_others():
+    async def run():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return "done"
+
+        leader = asyncio.ensure_future(flights.run("key", work))
+        follower = asyncio.ensure_future(flights.run("key", work))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == "done"
+
+
+def test_the_work_finishes_when_every_caller_is_cancelled():
+    async def run():
+        flights = SingleFlight()
+        release = asyncio.Event()
+        finished = []
+
+        async def work():
+            await release.wait()
+            finished.append(True)
+            raise RuntimeError("nobody is waiting")
+
+        caller = asyncio.ensure_future(flights.run("key", work))
+        await asyncio.sleep(0)
+        caller.cancel()
+        release.set()
+        for _ in range(3):
+            await asyncio.sleep(0)
+        return finished, flights.stats()
+
+    finished, stats = asyncio.run(run())
+    assert finished == [True]
+    assert stats["in_flight"] == 0
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from app.projection import euclidean_distances
+from app.spatial_index import SpatialIndex
+
+
+def brute_within(coords, points, radius):
+  distances = euclidean_distances(points[:, None], coords[None, :])
+  query_indices, tree_indices = np.nonzero(distances <= radius)
+  return query_indices, tree_indices, distances[query_indices, tree_indices]
+
+
+def brute_nearest(coords, points, k):
+  closest = np.full((len(points), k), -1, dtype=np.int64)
+  for i, point in enumerate(points):
+    distances = euclidean_distances(point[None], coords)
+    others = np.flatnonzero(distances > 0)
+    ranked = others[np.lexsort((others, distances[others]))][:k]
+    closest[i, :len(ranked)] = ranked
+  return closest
+
+
+def check_queries(index, coords, points, radius=3.0, k=4):
+  for found, expected in zip(index.within_many(points, radius), brute_within(coords, points, radius)):
+    np.testing.assert_array_equal(found, expected)
+  np.testing.assert_array_equal(index.any_within_many(points, radius), [
+    bool(len(brute_within(coords, point[None], radius)[0])) for point in points])
+  np.testing.assert_array_equal(index.nearest_many(points, k), brute_nearest(coords, points, k))
+
+
+def orchard_points(rng, n):
+  # Points on a coarse grid, so that there are duplicate points and ties in distance, plus jittered ones
+  grid = rng.integers(0, 12, size=(n // 2, 2)) * 2.0
+  return np.concatenate([grid, rng.uniform(-5, 30, size=(n - n // 2, 2))])
+
+
+@pytest.mark.parametrize("cell_size", [1.0, 2.5, 7.0])
+def test_queries_match_a_full_scan(cell_size):
+  rng = np.random.default_rng(0)
+  coords = orchard_points(rng, 400)
+  index = SpatialIndex(coords, cell_size=cell_size)
+  # Queries at the trees themselves, between them, and well outside the bounds of the index
+  points = np.concatenate([coords[:50], rng.uniform(-40, 70, size=(100, 2))])
+  check_queries(index, coords, points)
+  check_queries(index, coords, points, radius=0.0, k=1)
+  check_queries(index, coords, points, radius=20.0, k=10)
+
+
+def test_empty_and_single_point_indexes():
+  points = np.array([[0.0, 0.0], [1.0, 1.0], [-50.0, 80.0]])
+  empty = SpatialIndex(np.empty((0, 2)))
+  check_queries(empty, np.empty((0, 2)), points)
+  assert empty.nearest([0.0, 0.0]) == [] and not empty.any_within([0.0, 0.0], 10)
+
+  single = SpatialIndex(np.array([[1.0, 1.0]]))
+  check_queries(single, np.array([[1.0, 1.0]]), points)
+  assert single.nearest([0.0, 0.0]) == [0] and single.nearest([1.0, 1.0]) == []
+
+
+def test_insert_matches_a_full_scan():
+  rng = np.random.default_rng(1)
+  coords = orchard_points(rng, 200)
+  index = SpatialIndex(coords, cell_size=2.5)
+  points = rng.uniform(-40, 70, size=(100, 2))
+
+  # Trees inside the bounds are merged into the cells, and trees outside them rebuild the index
+  for new_trees in (coords[:20] + 0.5, coords[:5], rng.uniform(-30, -20, size=(10, 2)), np.empty((0, 2))):
+    indices = index.insert(new_trees)
+    np.testing.assert_array_equal(indices, np.arange(len(coords), len(coords) + len(new_trees)))
+    coords = np.concatenate([coords, new_trees])
+    check_queries(index, coords, points)
+    check_queries(index, coords, coords[-5:])
+
+
+def test_queries_in_chunks_match_a_full_scan(monkeypatch):
+  monkeypatch.setattr("app.spatial_index.QUERY_CHUNK_SIZE", 7)
+  rng = np.random.default_rng(2)
+  coords = orchard_points(rng, 300)
+  check_queries(SpatialIndex(coords, cell_size=1.0), coords, np.concatenate([coords, rng.uniform(-40, 70, (50, 2))]))
@@ -0,0 +1,195 @@
+import asyncio
+from urllib.parse import parse_qsl, urlsplit
+import httpx
+import numpy as np
+import pytest
+from app.upstream import AeroboticsClient
+
+BASE_URL = "http://aerobotics.test/"
+
+
+def survey_results(count):
+    return [{"id": i, "latitude": -32.0 - i * 1e-5, "longitude": 18.0, "survey_id": 7} for i in range(count)]
+
+
+def paginated_stub(results, page_size, requested, scheme="page", count=True):
+    """
+    A stub of the API that pages `results` by page number ("page", with no page_size in its next
+    links), by limit and offset ("offset"), or by an opaque cursor ("cursor"). Later pages are
+    answered sooner, so that pages fetched at once finish out of order.
+    """
+    async def handler(request):
+        requested.append(str(request.url))
+        query = dict(parse_qsl(urlsplit(str(request.url)).query))
+        if scheme == "page":
+            start = (int(query.get("page", 1)) - 1) * page_size
+            next_query = f"page={start // page_size + 2}"
+        elif scheme == "offset":
+            start = int(query.get("offset", 0))
+            next_query = f"limit={page_size}&offset={start + page_size}"
+        else:
+            start = int(query.get("cursor", "c0")[1:])
+            next_query = f"cursor=c{start + page_size}"
+        if start and start >= len(results):
+            return httpx.Response(404, json={"detail": "Invalid page."})
+
+        await asyncio.sleep(0.001 * max(10 - start // page_size, 0))
+        body = {"next": f"{BASE_URL}surveys?{next_query}" if start + page_size < len(results) else None,
+                "results": results[start:start + page_size]}
+        if count:
+            body["count"] = len(results)
+        return httpx.Response(200, json=body)
+
+    return handler
+
+
+def get_survey(handler, **kwargs):
+    async def run():
+        client = AeroboticsClient(BASE_URL, "key", transport=httpx.MockTransport(handler), backoff=0, **kwargs)
+        try:
+            return await client.get_survey("surveys", fields=("id",)), client.stats()
+        finally:
+            await client.aclose()
+
+    return asyncio.run(run())
+
+
+def test_trees_without_coordinates_do_not_shift_the_pages():
+    results = survey_results(300)
+    results[10]["latitude"] = None
+    requested = []
+    survey, _ = get_survey(paginated_stub(results, 100, requested))
+
+    assert len(requested) == 3
+    assert survey["results"] == 300
+    np.testing.assert_array_equal(survey["trees"].attributes["id"], [i for i in range(300) if i != 10])
+
+
+def flaky_stub(statuses, requested):
+    """
+    A stub of the API that answers with each of `statuses` in turn, then with 200 from then on.
+    An exception in `statuses` is raised as a transport error instead.
+    """
+    def handler(request):
+        requested.append(str(request.url))
+        status = statuses[len(requested) - 1] if len(requested) <= len(statuses) else 200
+        if isinstance(status, Exception):
+            raise status
+        return httpx.Response(status, json={"count": 0, "next": None, "results": []})
+
+    return handler
+
+
+def get_with_retries(handler, monkeypatch, retries=3, backoff=0.5):
+    delays = []
+
+    async def sleep(seconds):
+        delays.append(seconds)
+
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+
+    async def run():
+        client = AeroboticsClient(
+            BASE_URL, "key", transport=httpx.MockTransport(handler), retries=retries, backoff=backoff)
+        try:
+            return await client.get("surveys"), client.stats()
+        finally:
+            await client.aclose()
+
+    return asyncio.run(run()), delays
+
+
+def test_retries_with_backoff_on_temporary_errors(monkeypatch):
+    requested = []
+    (response, stats), delays = get_with_retries(flaky_stub([429, 503, 502], requested), monkeypatch)
+
+    assert response.status_code == 200
+    assert len(requested) == 4
+    assert delays == [0.5, 1.0, 2.0]
+    assert stats["requests"] == 4 and stats["retried"] == 3 and stats["failures"] == 0
+
+
+def test_does_not_retry_client_errors(monkeypatch):
+    requested = []
+    with pytest.raises(httpx.HTTPStatusError):
+        get_with_retries(flaky_stub([404], requested), monkeypatch)
+    assert len(requested) == 1
+
+
+def test_raises_the_last_error_after_every_retry(monkeypatch):
+    requested = []
+    with pytest.raises(httpx.HTTPStatusError) as error:
+        get_with_retries(flaky_stub([503] * 3, requested), monkeypatch, retries=2)
+    assert error.value.response.status_code == 503
+    assert len(requested) == 3
+
+
+def test_raises_transport_errors_after_every_retry(monkeypatch):
+    requested = []
+    error = httpx.ConnectError("Connection refused")
+    with pytest.raises(httpx.ConnectError):
+        get_with_retries(flaky_stub([error] * 3, requested), monkeypatch, retries=2)
+    assert len(requested) == 3
+
+
+def test_recovers_from_transport_errors(monkeypatch):
+    requested = []
+    (response, stats), delays = get_with_retries(
+        flaky_stub([httpx.ReadTimeout("Timed out")], requested), monkeypatch)
+    assert response.status_code == 200
+    assert delays == [0.5] and stats["retried"] == 1
+
+
+def check_survey(survey, results):
+    assert survey["count"] in (len(results), None)
+    np.testing.assert_array_equal(survey["trees"].attributes["id"], [result["id"] for result in results])
+    np.testing.assert_array_equal(
+        survey["trees"].coords, [(result["latitude"], result["longitude"]) for result in results])
+
+
+def test_pages_by_page_number():
+    results, requested = survey_results(950), []
+    survey, stats = get_survey(paginated_stub(results, 100, requested))
+    check_survey(survey, results)
+    assert len(requested) == 10 and stats["pages"] == 10
+
+
+def test_pages_by_limit_and_offset():
+    results, requested = survey_results(950), []
+    survey, stats = get_survey(paginated_stub(results, 100, requested, scheme="offset"))
+    check_survey(survey, results)
+    assert len(requested) == 10
+
+
+def test_follows_next_links_without_a_count():
+    results, requested = survey_results(250), []
+    survey, _ = get_survey(paginated_stub(results, 100, requested, count=False))
+    check_survey(survey, results)
+    assert survey["count"] is None
+    assert len(requested) == 3
+
+
+def test_follows_next_links_of_an_unrecognised_scheme():
+    results, requested = survey_results(250), []
+    survey, _ = get_survey(paginated_stub(results, 100, requested, scheme="cursor"))
+    check_survey(survey, results)
+    assert [url.rsplit("=", 1)[-1] for url in requested[1:]] == ["c100", "c200"]
+
+
+def test_single_page():
+    results, requested = survey_results(40), []
+    survey, _ = get_survey(paginated_stub(results, 100, requested))
+    check_survey(survey, results)
+    assert len(requested) == 1
+
+
+def test_raises_a_decoding_error_for_a_malformed_page():
+    requested = []
+
+    def handler(request):
+        requested.append(str(request.url))
+        return httpx.Response(200, content=b'{"count": 2, "next": null, "results": [{"latitude": -32.0, "longi')
+
+    with pytest.raises(httpx.DecodingError):
+        get_survey(handler)
+    assert len(requested) == 1
@@ -1,6 +1,32 @@
+import os
+import sys
 from coord_utils import *
 from visualise import * 
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app.orchard_utils import find_tree_clusters, find_tree_groups
+from app.projection import LocalProjection
+
+def find_tree_clusters_gps(trees, precision):
+  """
+  Cluster GPS coordinates of trees that are close to each other.
+
+  find_tree_clusters works in meters, so the trees are projected into a local frame to be
+  clustered, and the trees of each cluster are converted back to GPS coordinates.
+
+  Parameters:
+  - trees: List of tuples of the GPS coordinates (latitude, longitude) of the trees to cluster.
+  - precision: How close the trees should be to each other to form a cluster, in meters.
+
+  Returns:
+  - clusters: A list of dictionaries, each containing the list of trees (latitude, longitude) in the
+              cluster and the size of the cluster, as returned by find_tree_clusters.
+  """
+  projection = LocalProjection(trees)
+  clusters = find_tree_clusters(projection.to_local(trees), precision)
+  return [{"trees": [tuple(coord) for coord in projection.to_latlng(cluster["trees"]).tolist()], "size": cluster["size"]}
+          for cluster in clusters]
+
 def find_neighbour_trees(tree, all_trees, num_neighbours=4):
   """
   Find the closest coordinates to a target coordinate in a list.
@@ -89,24 +115,6 @@ def is_tree_at_location(check_tree, coords, precision):
   return False
 
 
-def find_tree_groups(trees, min_group_size, precision):
-  groups = []
-  for check_tree in trees: 
-    temp = [check_tree]
-    for tree in trees:
-      if check_tree != tree:
-        distance = haversine_distance(tree, check_tree)
-        if distance <= precision: 
-          temp.append(tree)
-
-    if len(temp) >= min_group_size:
-      groups.append(temp)
-    
-    # Remove these trees so we dont look at them again
-    for t in temp: 
-        trees.remove(t)
-  return groups
-
 def find_missing_trees(trees, orchard_features):
   missing_trees = []
   for tree in trees: 
@@ -1,8 +1,7 @@
 import json
 import random
 from visualise import *
-from orchard_utils import *
-import copy
+from viz_orchard_utils import *
 
 def main():
   f = open('response_1701867391762.json')
@@ -58,8 +57,9 @@ def main():
 
   ###########################
   ### Reject missing trees that arent in groups of 3 or more times and visualise 
-  m_trees = copy.deepcopy(missing_trees)
-  missing_tree_groups = find_tree_groups(m_trees, min_group_size=3, precision=2.5)
+  # Cluster once (in meters), and take both the missing and potentially missing groups from the clusters
+  missing_tree_clusters = find_tree_clusters_gps(missing_trees, precision=2.5)
+  missing_tree_groups = find_tree_groups(missing_trees, min_group_size=3, precision=2.5, clusters=missing_tree_clusters)
 
   # Visualise
   turtle.clear()
@@ -84,8 +84,7 @@ def main():
 
   ###########################
   ### Find potentially missing trees and visualise
-  p_m_trees = copy.deepcopy(missing_trees)
-  potentially_missing_tree_groups = find_tree_groups(p_m_trees, min_group_size=2, precision=2.5)
+  potentially_missing_tree_groups = find_tree_groups(missing_trees, min_group_size=2, precision=2.5, clusters=missing_tree_clusters)
 
   # Visualise
   turtle.clear()